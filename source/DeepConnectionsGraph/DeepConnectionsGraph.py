@@ -32,8 +32,10 @@ import importlib
 import random
 import queue
 
+from collections import defaultdict
 from pprint import pprint
 
+from gi.repository import GLib
 from gi.repository import Gtk
 
 from gramps.gen.plug import Gramplet
@@ -52,6 +54,9 @@ class Request:
 
 request = Request()
 
+UPDATE_DELAY = 500  # milliseconds; the changes during this time are applied together
+MAX_PATCHED_OBJECTS = 1000  # reload everything if more objects have changed
+
 basedir = os.path.split(__file__)[0]
 sys.path.append(basedir)
 os.chdir(basedir)
@@ -77,7 +82,7 @@ class WebServer(Thread):
         self.gramplet = gramplet
         self.port = port
         self.running = False
-        self.dbdata = connections.load_dbdata(gramplet.dbstate)
+        self.dbdata = connections.get_dbdata(gramplet.dbstate)
         self.refresh_needed = False
 
     def run(self):
@@ -153,31 +158,81 @@ class DeepConnectionsGraph(Gramplet):
         self.set_tooltip(_("Deep Connections Graph"))
         self.server = None
         self.running = True
+        self.pending_changes = defaultdict(set) # 'Person'/'Family'/'Event' -> handles
+        self.reload_needed = False
+        self.update_timer = None
 
     def db_changed(self):
         self.__clear(None)
         print("db changed: ",self.dbstate.db)
+        self.cancel_updates()
         if self.server:
-            self.server.dbdata = connections.load_dbdata(self.dbstate)
+            self.server.dbdata = connections.get_dbdata(self.dbstate)
 
         """Connect the signals that trigger an update."""
-        self.connect(self.dbstate.db, 'person-update', self.updated)
-        self.connect(self.dbstate.db, 'person-add', self.updated)
-        self.connect(self.dbstate.db, 'person-delete', self.updated)
+        self.connect(self.dbstate.db, 'person-update', self.person_changed)
+        self.connect(self.dbstate.db, 'person-add', self.person_changed)
+        self.connect(self.dbstate.db, 'person-delete', self.person_changed)
         self.connect(self.dbstate.db, 'person-rebuild', self.updated)
         self.connect(self.dbstate.db, 'family-rebuild', self.updated)
-        self.connect(self.dbstate.db, 'family-add', self.updated)
-        self.connect(self.dbstate.db, 'family-delete', self.updated)
-        self.connect(self.dbstate.db, 'family-update', self.updated)
+        self.connect(self.dbstate.db, 'family-add', self.family_changed)
+        self.connect(self.dbstate.db, 'family-delete', self.family_changed)
+        self.connect(self.dbstate.db, 'family-update', self.family_changed)
         self.connect(self.dbstate.db, 'event-rebuild', self.updated)
-        self.connect(self.dbstate.db, 'event-add', self.updated)
-        self.connect(self.dbstate.db, 'event-delete', self.updated)
-        self.connect(self.dbstate.db, 'event-update', self.updated)
+        self.connect(self.dbstate.db, 'event-add', self.event_changed)
+        self.connect(self.dbstate.db, 'event-delete', self.event_changed)
+        self.connect(self.dbstate.db, 'event-update', self.event_changed)
         
+    def person_changed(self, handles):
+        self.changed('Person', handles)
+
+    def family_changed(self, handles):
+        self.changed('Family', handles)
+
+    def event_changed(self, handles):
+        self.changed('Event', handles)
+
+    def changed(self, object_type, handles):
+        if self.server:
+            self.pending_changes[object_type].update(handles)
+            self.schedule_update()
+
     def updated(self, *args):
+        if self.server:
+            self.reload_needed = True
+            self.schedule_update()
+
+    def schedule_update(self):
+        "Applies the changes after a while so that a burst of signals is handled at once"
+        if self.update_timer is None:
+            self.update_timer = GLib.timeout_add(UPDATE_DELAY, self.apply_updates)
+
+    def cancel_updates(self):
+        if self.update_timer is not None:
+            GLib.source_remove(self.update_timer)
+            self.update_timer = None
+        self.pending_changes = defaultdict(set)
+        self.reload_needed = False
+
+    def apply_updates(self):
+        """
+        Patches the changed objects into a new dbdata (or reloads everything
+        if there are many changes) and then replaces the one used by the server.
+        """
+        self.update_timer = None
+        changes = self.pending_changes
+        self.pending_changes = defaultdict(set)
+        reload_needed = self.reload_needed
+        self.reload_needed = False
         if self.server:
             self.server.refresh_needed = True
-            self.server.dbdata = connections.load_dbdata(self.dbstate)
+            if reload_needed or sum(len(handles) for handles in changes.values()) > MAX_PATCHED_OBJECTS:
+                self.server.dbdata = connections.get_dbdata(self.dbstate)
+            else:
+                # the patched dbdata is not saved as a snapshot: the change
+                # marker also covers the notes, which are not patched
+                self.server.dbdata = connections.patch_dbdata(self.dbstate, self.server.dbdata, changes)
+        return False
 
     def __clear(self, obj):
         pass
@@ -278,6 +333,7 @@ class DeepConnectionsGraph(Gramplet):
             return
         print("stopping server")
         self.append_text("stopping server\n")
+        self.cancel_updates()
         self.server.running = False
         self.server.httpd.shutdown()
         self.server.httpd.server_close()
@@ -290,7 +346,8 @@ class DeepConnectionsGraph(Gramplet):
         
     def cb_refresh(self,obj):
         if self.server:
-            self.server.dbdata = connections.load_dbdata(self.dbstate)
+            self.cancel_updates()
+            self.server.dbdata = connections.get_dbdata(self.dbstate)
             self.server.refresh_needed = False
             self.append_text("loaded new dbdata\n")
 
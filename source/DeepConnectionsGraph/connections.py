@@ -11,10 +11,17 @@ Author: kari.kujansuu@gmail.com, 2019
 # Python modules
 #
 #------------------------------------------------------------------------
+from array import array
 from collections import defaultdict
 import json
+import mmap
 import os
+import pathlib
+import pickle
 from pprint import pprint
+import sqlite3
+import sys
+import zlib
 
 #------------------------------------------------------------------------
 #
@@ -40,15 +47,258 @@ endnode_color   = "#aaffff"
 bgcolor         = "lightsteelblue"
 
 DEBUG = False
+
+SNAPSHOT_FILENAME = "deepconnections.snapshot"  # in the family tree directory
+SNAPSHOT_MAGIC = b"DCGRAPH\0"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ARRAYS = ("node_types", "offsets", "targets", "types", "categories")
+
+# link categories (bit masks); the links between relatives have no category
+EVENTS = 1
+NOTES = 2
+ASSOCIATIONS = 4
+
+def link_category(assoc_type, from_node, to_node):
+    category = 0
+    if from_node[0] == 'Event' or to_node[0] == 'Event':
+        category |= EVENTS
+    if assoc_type in ("note","<note"):
+        category |= NOTES
+    if assoc_type.startswith("assoc:") or assoc_type.startswith("<assoc:"):
+        category |= ASSOCIATIONS
+    return category
+
+def category_names(mask):
+    return [name for bit, name in ((EVENTS, "events"), (NOTES, "notes"), (ASSOCIATIONS, "associations"))
+            if mask & bit]
+
+def get_sortkey(assoc_type):
+    if assoc_type[0] == "<": assoc_type = assoc_type[1:]
+    if assoc_type == "parent_family":
+        return 1
+    if assoc_type == "family":
+        return 2
+    return 3
+
+class Graph:
+    """
+    Compact form of the links between the nodes (people, families, events etc.).
+
+    The nodes are numbered 0..n-1 and the links of node i (in both directions)
+    are the edges offsets[i]..offsets[i+1]-1. For edge e, targets[e] is the node
+    at the other end, types[e] indexes assoc_types (e.g. "family" or "<family" for
+    the reverse direction) and categories[e] is the link category bit mask.
+
+    When the links of a node change (set_links), its new edges are appended to
+    the edge arrays and ranges maps the node id to (start, end) of the edges,
+    overriding offsets. Graph objects sharing the arrays never see the edges
+    appended for the others.
+    """
+    def __init__(self):
+        self.handles = [] # node id -> handle
+        self.node_types = array("B") # node id -> index to node_type_names
+        self.node_type_names = []
+        self.node_ids = {} # (handle_type,handle) -> node id
+        self.assoc_types = [] # type code -> assoc_type
+        self.type_codes = {} # assoc_type -> type code
+        self.offsets = array("i", [0])
+        self.targets = array("i")
+        self.types = array("i")
+        self.categories = array("B")
+        self.ranges = {} # node id -> (start, end) for the nodes changed after finish()
+        self.garbage = 0 # number of edges no longer used by any node
+        # links added before finish(), without the reverse links
+        self.link_from = array("i")
+        self.link_to = array("i")
+        self.link_types = array("i")
+
+    def __len__(self):
+        return len(self.handles)
+
+    def get_node_id(self, node):
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            node_type, handle = node
+            if node_type not in self.node_type_names:
+                self.node_type_names.append(node_type)
+            node_id = len(self.handles)
+            self.node_ids[node] = node_id
+            self.handles.append(handle)
+            self.node_types.append(self.node_type_names.index(node_type))
+        return node_id
+
+    def get_node(self, node_id):
+        return (self.node_type_names[self.node_types[node_id]], self.handles[node_id])
+
+    def get_type_code(self, assoc_type):
+        code = self.type_codes.get(assoc_type)
+        if code is None:
+            code = len(self.assoc_types)
+            self.type_codes[assoc_type] = code
+            self.assoc_types.append(assoc_type)
+        return code
+
+    def add_link(self, assoc_type, from_node, to_node):
+        self.link_from.append(self.get_node_id(from_node))
+        self.link_to.append(self.get_node_id(to_node))
+        self.link_types.append(self.get_type_code(assoc_type))
+
+    def finish(self):
+        """
+        Builds the edge arrays from the added links and their reverse links.
+        The links of each node are ordered by the sort key of the link type.
+        """
+        reverse_codes = [self.get_type_code("<"+assoc_type) for assoc_type in list(self.assoc_types)]
+        sortkeys = [get_sortkey(assoc_type) for assoc_type in self.assoc_types]
+        n = len(self.handles)
+        offsets = array("i", [0]) * (n + 1)
+        for u, v in zip(self.link_from, self.link_to):
+            offsets[u+1] += 1
+            offsets[v+1] += 1
+        for i in range(n):
+            offsets[i+1] += offsets[i]
+        numedges = offsets[n]
+        targets = array("i", [0]) * numedges
+        types = array("i", [0]) * numedges
+        positions = offsets[:-1]
+        for sortkey in (1, 2, 3):
+            for u, v, t in zip(self.link_from, self.link_to, self.link_types):
+                if sortkeys[t] != sortkey: continue
+                e = positions[u]
+                positions[u] += 1
+                targets[e] = v
+                types[e] = t
+            for u, v, t in zip(self.link_from, self.link_to, self.link_types):
+                if sortkeys[t] != sortkey: continue
+                e = positions[v]
+                positions[v] += 1
+                targets[e] = u
+                types[e] = reverse_codes[t]
+        # an edge is in the events category if either end is an event
+        type_categories = [link_category(assoc_type, ('',None), ('',None)) for assoc_type in self.assoc_types]
+        event_type = self.node_type_names.index('Event') if 'Event' in self.node_type_names else -1
+        node_types = self.node_types
+        categories = array("B", [0]) * numedges
+        for u in range(n):
+            event_node = node_types[u] == event_type
+            for e in range(offsets[u], offsets[u+1]):
+                category = type_categories[types[e]]
+                if event_node or node_types[targets[e]] == event_type:
+                    category |= EVENTS
+                categories[e] = category
+        self.offsets = offsets
+        self.targets = targets
+        self.types = types
+        self.categories = categories
+        self.link_from = array("i")
+        self.link_to = array("i")
+        self.link_types = array("i")
+
+    def get_range(self, node_id):
+        "The (start, end) of the edges of node node_id"
+        edge_range = self.ranges.get(node_id)
+        if edge_range is not None:
+            return edge_range
+        if node_id + 1 < len(self.offsets):
+            return self.offsets[node_id], self.offsets[node_id+1]
+        return 0, 0
+
+    def get_link(self, node_id, edge):
+        "The link for the edge from node node_id"
+        assoc_type = self.assoc_types[self.types[edge]]
+        return Link(assoc_type, self.get_node(node_id), self.get_node(self.targets[edge]),
+                    reverse=assoc_type[0] == "<")
+
+    def get_links(self, node):
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            return []
+        return [self.get_link(node_id, e) for e in range(*self.get_range(node_id))]
+
+    def copy(self):
+        """
+        Returns a copy that can be changed with set_links without affecting this
+        graph. The edge arrays are shared since the changes only append to them.
+        """
+        graph = Graph()
+        for name in SNAPSHOT_ARRAYS:
+            data = getattr(self, name)
+            if not isinstance(data, array) and name != "offsets":
+                # memory mapped from a snapshot
+                data = array(data.format, data.tobytes())
+            setattr(graph, name, data)
+        graph.handles = list(self.handles)
+        graph.node_type_names = list(self.node_type_names)
+        graph.node_ids = dict(self.node_ids)
+        graph.assoc_types = list(self.assoc_types)
+        graph.type_codes = dict(self.type_codes)
+        graph.ranges = dict(self.ranges)
+        graph.garbage = self.garbage
+        return graph
+
+    def set_edges(self, node_id, edges):
+        "Replaces the edges of node node_id with edges: [(target, type), ...]"
+        start, end = self.get_range(node_id)
+        self.garbage += end - start
+        def sortkey(edge):
+            assoc_type = self.assoc_types[edge[1]]
+            return (get_sortkey(assoc_type), assoc_type[0] == "<")
+        start = len(self.targets)
+        for v, t in sorted(edges, key=sortkey):
+            self.targets.append(v)
+            self.types.append(t)
+            self.categories.append(link_category(self.assoc_types[t], self.get_node(node_id), self.get_node(v)))
+        self.ranges[node_id] = (start, len(self.targets))
+
+    def set_links(self, node, links):
+        """
+        Replaces the links from node (those added with add_link) with links:
+        [(assoc_type, to_node), ...]. The reverse links are updated too.
+        """
+        u = self.get_node_id(node)
+        changed = {}  # node id -> new edges
+        def get_edges(v):
+            if v not in changed:
+                changed[v] = [(self.targets[e], self.types[e]) for e in range(*self.get_range(v))]
+            return changed[v]
+        for v, t in list(get_edges(u)):
+            assoc_type = self.assoc_types[t]
+            if assoc_type[0] != "<":
+                get_edges(u).remove((v, t))
+                get_edges(v).remove((u, self.get_type_code("<"+assoc_type)))
+        for assoc_type, to_node in links:
+            v = self.get_node_id(to_node)
+            get_edges(u).append((v, self.get_type_code(assoc_type)))
+            get_edges(v).append((u, self.get_type_code("<"+assoc_type)))
+        for v, edges in changed.items():
+            self.set_edges(v, edges)
+
+    def compacted(self):
+        "Returns a copy without the unused edges and the ranges"
+        graph = self.copy()
+        graph.ranges = {}
+        graph.garbage = 0
+        graph.offsets = array("i", [0])
+        graph.targets = array("i")
+        graph.types = array("i")
+        graph.categories = array("B")
+        for u in range(len(self.handles)):
+            start, end = self.get_range(u)
+            graph.targets.extend(self.targets[start:end])
+            graph.types.extend(self.types[start:end])
+            graph.categories.extend(self.categories[start:end])
+            graph.offsets.append(len(graph.targets))
+        return graph
+
 class DBData:
     def __init__(self):
-        self.xref = defaultdict(list)  # (handle_type,handle) -> [Link(assoc_type, handle_type, handle, [role]), ]
+        self.graph = Graph()
         self.names = {} # personhandle -> (name,years)
         self.family_names = {} # family_handle -> name
         self.events = {} # eventhandle -> (type, gramps_id, description)
     
 class Link:
-    def __init__(self, assoc_type, from_node, to_node, reverse=False, sortkey=0):  
+    def __init__(self, assoc_type, from_node, to_node, reverse=False, sortkey=0, category=0):  
         # assoc_type = 'family', 'parent_family', 'assoc', <event-role>
         # from_node/to_node = (node_type, handle), eg. ('Person', '22d9be333eee272e9e166b2572215')
         
@@ -56,13 +306,8 @@ class Link:
         self.from_node = from_node
         self.to_node = to_node
         self.reverse = reverse
-        if assoc_type[0] == "<": assoc_type = assoc_type[1:]
-        if assoc_type == "parent_family": 
-            self.sortkey = 1
-        elif assoc_type == "family": 
-            self.sortkey = 2
-        else:
-            self.sortkey = 3
+        self.category = link_category(assoc_type, from_node, to_node)
+        self.sortkey = get_sortkey(assoc_type)
             
     def __hash__(self):
         return hash((self.assoc_type,self.from_node,self.to_node,self.reverse))
@@ -76,6 +321,12 @@ class Link:
     def copy(self):
         return Link(self.assoc_type, self.from_node, self.to_node, self.reverse)
 
+    def reversed(self):
+        "The link in the opposite direction, as generated in load_dbdata"
+        if self.assoc_type[0] == "<":
+            return Link(self.assoc_type[1:], self.to_node, self.from_node)
+        return Link("<"+self.assoc_type, self.to_node, self.from_node, reverse=True)
+
     @staticmethod            
     def default(obj):
          #if isinstance(obj, Link):
@@ -93,18 +344,49 @@ class Link:
             return link
         return objdict
 
-def add_notelinks(dbstate, dbdata, key, person):
-    for note_handle in person.get_note_list():
+def get_notelinks(dbstate, obj):
+    "Returns the links from the notes of obj (person, family or event) as (assoc_type, to_node)"
+    links = []
+    for note_handle in obj.get_note_list():
         note = dbstate.db.get_note_from_handle(note_handle)
-        links = note.get_links()
-        for link in links:
+        for link in note.get_links():
             #print(link)
             # esim. ('gramps', 'Person', 'handle', 'e6b5be02dfb30ff524c96f5d7d1')
             if link[0] == "gramps": # and link[1] == "Person":
                 if link[2] == "handle":
                     object_type = link[1]
                     linkhandle = link[3]
-                    dbdata.xref[key].append(Link("note",key,(object_type,linkhandle)))
+                    links.append(("note", (object_type,linkhandle)))
+    return links
+
+def get_role(eventref):
+    role = str(eventref.role)
+    try:
+        role = role.encode("utf-8").decode("iso8859-1")  # role seems to have an invalid encoding, trying to fix
+    except:
+        pass
+    return role
+
+def get_person_links(dbstate, person):
+    links = []
+    for family_handle in person.get_family_handle_list():
+        links.append(("family", ('Family', family_handle)))
+    for family_handle in person.get_parent_family_handle_list():
+        links.append(("parent_family", ('Family', family_handle)))
+    for eventref in person.get_event_ref_list():
+        links.append((get_role(eventref), ('Event', eventref.ref)))
+    for assoc in person.get_person_ref_list():
+        links.append(("assoc: " + assoc.rel, ('Person', assoc.get_reference_handle())))
+    return links + get_notelinks(dbstate, person)
+
+def get_family_links(dbstate, family):
+    links = []
+    for eventref in family.get_event_ref_list():
+        links.append((get_role(eventref), ('Event', eventref.ref)))
+    return links + get_notelinks(dbstate, family)
+
+def get_event_info(event):
+    return ( str(event.get_type()), event.gramps_id, event.get_description() )
 
 def load_dbdata(dbstate):
     dbdata = DBData()
@@ -115,58 +397,246 @@ def load_dbdata(dbstate):
         name = name_displayer.display(person)
         years = utils.get_years( dbstate, person )
         dbdata.names[person_handle] = (name,years)
-        assoc_list = person.get_person_ref_list()
         key = ('Person',person_handle)
-        for family_handle in person.get_family_handle_list():
-            dbdata.xref[key].append(Link("family", key, ('Family', family_handle)))
-        for family_handle in person.get_parent_family_handle_list():
-            dbdata.xref[key].append(Link("parent_family", key, ('Family', family_handle)))
-        for eventref in person.get_event_ref_list():
-            event_handle = eventref.ref
-            event = dbstate.db.get_event_from_handle(event_handle)
-            role = str(eventref.role)
-            try:
-                role = role.encode("utf-8").decode("iso8859-1")  # role seems to have an invalid encoding, trying to fix
-            except:
-                pass
-            if True or event.get_type() == "Kaste":
-                dbdata.xref[key].append(Link(role, key, ('Event', event_handle) ))
-        for assoc in assoc_list:
-            assoc_handle = assoc.get_reference_handle()
-            dbdata.xref[key].append(Link("assoc: " + assoc.rel, key, ('Person', assoc_handle)))
-        add_notelinks(dbstate, dbdata, key, person)
+        for assoc_type, to_node in get_person_links(dbstate, person):
+            dbdata.graph.add_link(assoc_type, key, to_node)
 
     for family_handle in dbstate.db.get_family_handles():
         family = dbstate.db.get_family_from_handle(family_handle)
         name = get_family_name(dbstate, family)
         dbdata.family_names[family_handle] = name
         key = ('Family',family_handle)
-        for eventref in family.get_event_ref_list():
-            event_handle = eventref.ref
-            role = str(eventref.role)
-            try:
-                role = role.encode("utf-8").decode("iso8859-1")  # role seems to have an invalid encoding, trying to fix
-            except:
-                pass
-            dbdata.xref[key].append(Link(role, key, ('Event', event_handle) ))
-        add_notelinks(dbstate, dbdata, key, family)
+        for assoc_type, to_node in get_family_links(dbstate, family):
+            dbdata.graph.add_link(assoc_type, key, to_node)
 
     for event_handle in dbstate.db.get_event_handles():
         event = dbstate.db.get_event_from_handle(event_handle)
-        dbdata.events[event_handle] = ( event.get_type(), event.gramps_id, event.get_description() )
+        dbdata.events[event_handle] = get_event_info(event)
         key = ('Event',event_handle)
-        add_notelinks(dbstate, dbdata, key, event)
+        for assoc_type, to_node in get_notelinks(dbstate, event):
+            dbdata.graph.add_link(assoc_type, key, to_node)
 
     # generate reverse links
-    dbdata2 = DBData()
-    for links in list(dbdata.xref.values())[:]:
-        for link in links[:]:
-            if link.assoc_type[0] == "<": continue
-            dbdata.xref[link.to_node].append(Link("<"+link.assoc_type, link.to_node, link.from_node, reverse=True))
-    for key,links in dbdata.xref.items():
-        dbdata.xref[key] = sorted(links, key=lambda link: link.sortkey )            
+    dbdata.graph.finish()
     print("loaded new dbdata")
     return dbdata
+
+def patch_dbdata(dbstate, dbdata, changes):
+    """
+    Returns a new dbdata where the changed objects are reloaded from the
+    database. changes maps 'Person', 'Family' and 'Event' to sets of changed
+    (added, updated or deleted) handles. dbdata itself is not modified so it
+    can be used by the server until the new one replaces it.
+    """
+    db = dbstate.db
+    newdata = DBData()
+    newdata.dbname = dbdata.dbname
+    newdata.names = dict(dbdata.names)
+    newdata.family_names = dict(dbdata.family_names)
+    newdata.events = dict(dbdata.events)
+    graph = newdata.graph = dbdata.graph.copy()
+    person_handles = set(changes.get('Person', ()))
+    family_handles = set(changes.get('Family', ()))
+    family_name_handles = set()
+
+    for event_handle in changes.get('Event', ()):
+        key = ('Event', event_handle)
+        if not db.has_event_handle(event_handle):
+            newdata.events.pop(event_handle, None)
+            graph.set_links(key, [])
+            continue
+        event = db.get_event_from_handle(event_handle)
+        newdata.events[event_handle] = get_event_info(event)
+        graph.set_links(key, get_notelinks(dbstate, event))
+        # the birth and death years are shown with the names
+        for _, person_handle in db.find_backlink_handles(event_handle, ['Person']):
+            person_handles.add(person_handle)
+
+    for person_handle in person_handles:
+        key = ('Person', person_handle)
+        if not db.has_person_handle(person_handle):
+            newdata.names.pop(person_handle, None)
+            graph.set_links(key, [])
+            continue
+        person = db.get_person_from_handle(person_handle)
+        newdata.names[person_handle] = (name_displayer.display(person), utils.get_years(dbstate, person))
+        graph.set_links(key, get_person_links(dbstate, person))
+        # the family names consist of the names of the parents
+        family_name_handles.update(person.get_family_handle_list())
+
+    for family_handle in family_handles:
+        key = ('Family', family_handle)
+        if not db.has_family_handle(family_handle):
+            newdata.family_names.pop(family_handle, None)
+            graph.set_links(key, [])
+            continue
+        family = db.get_family_from_handle(family_handle)
+        graph.set_links(key, get_family_links(dbstate, family))
+        family_name_handles.add(family_handle)
+
+    for family_handle in family_name_handles:
+        if db.has_family_handle(family_handle):
+            family = db.get_family_from_handle(family_handle)
+            newdata.family_names[family_handle] = get_family_name(dbstate, family)
+
+    if graph.garbage > len(graph.targets) // 2:
+        newdata.graph = graph.compacted()
+    return newdata
+
+def get_dbdata(dbstate):
+    """
+    Returns the dbdata from the snapshot file if it is up to date, otherwise
+    loads it from the database and saves a new snapshot.
+    """
+    db = dbstate.db
+    marker = get_change_marker(db)
+    if marker is not None:
+        dbdata = load_snapshot(db, marker)
+        if dbdata:
+            print("loaded dbdata from snapshot")
+            return dbdata
+    dbdata = load_dbdata(dbstate)
+    if marker is not None:
+        save_snapshot(db, dbdata, marker)
+    return dbdata
+
+def get_change_marker(db):
+    """
+    Returns a value that changes whenever the people, families, events or notes
+    in the database change (or the name format changes). Returns None if the
+    database is not stored in a directory.
+
+    For SQLite the marker is computed from the tables since Gramps also
+    writes to the database file when the family tree is closed: the number of
+    rows and the newest and the sum of the change times, or a checksum of the
+    rows if the table has no change column. For other backends it is the
+    newest modification time of the files in the database directory.
+    """
+    dirpath = db.get_save_path()
+    if not dirpath or not os.path.isdir(dirpath):
+        return None
+    marker = [SNAPSHOT_VERSION, name_displayer.get_default_format()]
+    fname = os.path.join(dirpath, "sqlite.db")
+    if os.path.exists(fname):
+        uri = pathlib.Path(fname).as_uri() + "?mode=ro"
+        try:
+            conn = sqlite3.connect(uri, uri=True, timeout=10)
+            try:
+                for table in ("person", "family", "event", "note"):
+                    columns = [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+                    if "change" in columns:
+                        # an edited or added object has a newer change time and
+                        # a deleted one decreases the count
+                        query = "SELECT count(*), max(change), sum(change) FROM {}".format(table)
+                        marker.append((table,) + conn.execute(query).fetchone())
+                        continue
+                    column = "blob_data" if "blob_data" in columns else "json_data"
+                    if column not in columns:
+                        return None
+                    count = checksum = 0
+                    for handle, data in conn.execute("SELECT handle, {} FROM {}".format(column, table)):
+                        if isinstance(data, str):
+                            data = data.encode("utf-8")
+                        checksum += zlib.crc32(data, zlib.crc32(handle.encode("utf-8")))
+                        count += 1
+                    marker.append((table, count, checksum))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print("cannot read", fname, e)
+            return None
+        return marker
+    newest = 0
+    for name in os.listdir(dirpath):
+        if name == "lock" or name.startswith(SNAPSHOT_FILENAME):
+            continue
+        newest = max(newest, os.stat(os.path.join(dirpath, name)).st_mtime_ns)
+    marker.append(newest)
+    return marker
+
+def save_snapshot(db, dbdata, marker):
+    """
+    Writes dbdata to the snapshot file: a prefix containing the position of
+    the header, the graph arrays (aligned, so they can be memory mapped) and
+    a pickled header with the rest of the data and the change marker.
+    """
+    fname = os.path.join(db.get_save_path(), SNAPSHOT_FILENAME)
+    tmpname = fname + ".tmp"
+    graph = dbdata.graph
+    if graph.ranges:
+        graph = graph.compacted()
+    sections = {}
+    try:
+        with open(tmpname, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + bytes(8))
+            for name in SNAPSHOT_ARRAYS:
+                data = getattr(graph, name)
+                if f.tell() % 8:
+                    f.write(bytes(8 - f.tell() % 8))
+                typecode = data.typecode if isinstance(data, array) else data.format
+                sections[name] = (typecode, f.tell(), len(data))
+                f.write(data)
+            header = dict(
+                version=SNAPSHOT_VERSION,
+                marker=marker,
+                byteorder=sys.byteorder,
+                sections=sections,
+                handles=graph.handles,
+                node_type_names=graph.node_type_names,
+                assoc_types=graph.assoc_types,
+                dbname=dbdata.dbname,
+                names=dbdata.names,
+                family_names=dbdata.family_names,
+                events=dbdata.events,
+            )
+            header_pos = f.tell()
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.seek(len(SNAPSHOT_MAGIC))
+            f.write(header_pos.to_bytes(8, "little"))
+        os.replace(tmpname, fname)
+    except OSError as e:
+        print("cannot save snapshot", fname, e)
+        utils.removefile(tmpname)
+
+def load_snapshot(db, marker):
+    """
+    Returns the dbdata from the snapshot file or None if there is no snapshot
+    or it does not match the marker. The graph arrays are memory mapped.
+    """
+    fname = os.path.join(db.get_save_path(), SNAPSHOT_FILENAME)
+    try:
+        with open(fname, "rb") as f:
+            prefix = f.read(len(SNAPSHOT_MAGIC) + 8)
+            if prefix[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                return None
+            f.seek(int.from_bytes(prefix[len(SNAPSHOT_MAGIC):], "little"))
+            header = pickle.load(f)
+            if (header["version"] != SNAPSHOT_VERSION or header["marker"] != marker
+                    or header["byteorder"] != sys.byteorder):
+                return None
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("cannot load snapshot", fname, e)
+        return None
+    graph = Graph()
+    for name, (typecode, pos, count) in header["sections"].items():
+        size = array(typecode).itemsize
+        setattr(graph, name, buf[pos:pos+count*size].cast(typecode))
+    graph.handles = header["handles"]
+    graph.node_type_names = header["node_type_names"]
+    graph.assoc_types = header["assoc_types"]
+    graph.type_codes = {assoc_type: code for code, assoc_type in enumerate(graph.assoc_types)}
+    graph.node_ids = {(graph.node_type_names[node_type], handle): node_id
+                      for node_id, (node_type, handle) in enumerate(zip(graph.node_types, graph.handles))}
+    dbdata = DBData()
+    dbdata.graph = graph
+    dbdata.dbname = header["dbname"]
+    dbdata.names = header["names"]
+    dbdata.family_names = header["family_names"]
+    dbdata.events = header["events"]
+    return dbdata
     
 
 def get_family_name(dbstate, family):
@@ -343,13 +813,7 @@ class VeryDeepConnections:
         """
         Gets all of the relations of handle.
         """
-        return self.dbdata.xref[(object_type,handle)]
-
-    def contains(self, path, new_handle):
-        for link in path:
-            if link.to_node[1] == new_handle:
-                return True
-        return False
+        return self.dbdata.graph.get_links((object_type,handle))
 
     def getname(self,current_type, current_handle):
         if current_type == 'Person':
@@ -361,83 +825,192 @@ class VeryDeepConnections:
         return "??? " + current_type + ": " + current_handle
         
     def generate_paths(self, person1handle, person2handle, maxpaths, throttle):
-        c  = VeryDeepConnections( self.server, self.dbdata, 
-            use_relatives=True, use_events=False, use_notes=False, use_associations=False, use_places=False)
-        #yield from c.generate_paths1(person1handle, person2handle, maxpaths, throttle)
-        if self.use_events:        
-            c  = VeryDeepConnections( self.server, self.dbdata, 
-                use_relatives=True, use_events=True, use_notes=False, use_associations=False, use_places=False)
-            yield from c.generate_paths1(person1handle, person2handle, maxpaths, throttle)
-        if self.use_notes:        
-            c  = VeryDeepConnections( self.server, self.dbdata, 
-                use_relatives=True, use_events=self.use_events, use_notes=True, use_associations=False, use_places=False)
-            yield from c.generate_paths1(person1handle, person2handle, maxpaths, throttle)
-        if self.use_associations:        
-            c  = VeryDeepConnections( self.server, self.dbdata, 
-                use_relatives=True, use_events=self.use_events, use_notes=self.use_notes, use_associations=True, use_places=False)
-            yield from c.generate_paths1(person1handle, person2handle, maxpaths, throttle)
-
-    def generate_paths1(self, person1handle, person2handle, maxpaths, throttle):
-        total_relations_found = 0
-        #print("generate_paths", person1handle, person2handle)
-        #throttle = False
-
-        visited = set()
-        link = Link("self", (None,None), ('Person', person1handle))
-        link.counter = 0
-        queue = [[link]]
-        counter1 = 0
-        counter2 = 0
-        import time
-        #time.sleep(10)
-        while queue and self.server.running:
-            counter1 += 1
-            #if counter1 > 500000: break
-            if DEBUG:
-                print("queue:")
-                pprint(self.queue)
-            current_path = queue.pop(0)
-            lastlink = current_path[-1]
-            (current_type, current_handle) = lastlink.to_node
-            if DEBUG and counter1 < 200:
-                print(counter1,"got",self.getname(current_type, current_handle),lastlink.counter)
-            if current_handle == person2handle:
-                total_relations_found += 1
-                #print("---> yield",counter1, current_path)
-                yield current_path
-                if total_relations_found >= maxpaths:
-                    break                   
-            if current_type == 'Person' and current_handle in visited:
-            #if current_handle in visited:
-                if DEBUG and counter1 < 200:
-                    print("- skipped: ", counter1, self.getname(current_type, current_handle))
-                continue
-            visited.add(current_handle)
-            #if len(current_path) > 24: continue
-            for link in self.dbdata.xref[(current_type,current_handle)]:
-                counter2 += 1
-                if DEBUG: 
-                    print(">> path:", link )
-                if not self.use_events and link.from_node[0] == 'Event': continue
-                if not self.use_events and link.to_node[0] == 'Event': continue
-                if not self.use_notes and link.assoc_type in ("note","<note"): continue
-                if (not self.use_associations and (
-                    link.assoc_type.startswith("assoc:") or
-                    link.assoc_type.startswith("<assoc:"))
-                ):
-                    continue
+        for categories, path in self.generate_tagged_paths(person1handle, person2handle, maxpaths, throttle):
+            yield path
 
-                if DEBUG and counter1 < 200:
-                    print("- link: ", counter1, self.getname(*link.to_node))
-                if self.contains( current_path, link.to_node[1]): 
-                    if DEBUG and counter1 < 200:
-                        print("- skipped2: ", counter1, self.getname(*link.to_node))
-                    continue
+    def get_passes(self):
+        """
+        The category sets that used to be searched one after another: first with events,
+        then adding notes, then adding associations (each only if enabled).
+        """
+        passes = []
+        mask = 0
+        if self.use_events:
+            mask |= EVENTS
+            passes.append(mask)
+        if self.use_notes:
+            mask |= NOTES
+            passes.append(mask)
+        if self.use_associations:
+            mask |= ASSOCIATIONS
+            passes.append(mask)
+        return passes
+
+    def generate_tagged_paths(self, person1handle, person2handle, maxpaths, throttle):
+        """
+        Searches all the enabled link categories in one traversal. Yields
+        (categories, path) where categories are the names of the link categories
+        the path needs (empty for a path through relatives only).
+        """
+        passes = self.get_passes()
+        if not passes:
+            return
+        for mask, path in self.generate_paths1(person1handle, person2handle, passes, maxpaths):
+            yield category_names(mask), path
 
-                if link.to_node[1] != current_handle and link.to_node[1] != link.from_node[1]:
-                    link.counter = counter1
-                    queue.append( current_path + [link] )
-                    #queue.sort(key=lambda links: links[0].sortkey)
-                    
-                    
-        
+    def expand(self, frontier, depth, dist, parents, levels, maxlevel):
+        """
+        Visits the neighbours of the states in the frontier (all at the same depth)
+        and returns the new frontier. A state is a node id together with the level of
+        the path to it: the index of the first pass that allows all the links in the
+        path. dist maps node id -> {level: depth}. A new state gets all its neighbours in
+        the frontier as parents (with the edge used), so all shortest paths can be
+        reconstructed later. A state is skipped if the node was reached at a lower
+        level at a smaller depth.
+        """
+        newfrontier = []
+        graph = self.dbdata.graph
+        offsets = graph.offsets
+        targets = graph.targets
+        categories = graph.categories
+        ranges = graph.ranges
+        for state in frontier:
+            node, level = state
+            edge_range = ranges.get(node)
+            if edge_range is None:
+                edge_range = (offsets[node], offsets[node+1])
+            for e in range(*edge_range):
+                linklevel = levels[categories[e]]
+                if linklevel is None: continue
+                if linklevel < level: linklevel = level
+                if linklevel > maxlevel: continue
+                nextnode = targets[e]
+                if nextnode == node: continue
+                labels = dist.get(nextnode)
+                if labels is None:
+                    labels = dist[nextnode] = {}
+                d = labels.get(linklevel)
+                if d is None:
+                    if any(l < linklevel and dl <= depth for l, dl in labels.items()):
+                        continue
+                    labels[linklevel] = depth + 1
+                    nextstate = (nextnode, linklevel)
+                    newfrontier.append(nextstate)
+                elif d != depth + 1:
+                    continue
+                else:
+                    nextstate = (nextnode, linklevel)
+                parents[nextstate].append((state, e))
+        return newfrontier
+
+    def paths_from_start(self, parents, state):
+        "Generates the shortest paths from the start node to state"
+        if not parents[state]:
+            yield []
+        for prevstate, e in parents[state]:
+            link = self.dbdata.graph.get_link(prevstate[0], e)
+            for path in self.paths_from_start(parents, prevstate):
+                yield path + [link]
+
+    def paths_to_end(self, parents, state):
+        """
+        Generates the shortest paths from state to the end node. The backward
+        search stored the edges in the direction from the end node.
+        """
+        if not parents[state]:
+            yield []
+        for nextstate, e in parents[state]:
+            link = self.dbdata.graph.get_link(nextstate[0], e).reversed()
+            for path in self.paths_to_end(parents, nextstate):
+                yield [link] + path
+
+    def generate_paths1(self, person1handle, person2handle, passes, maxpaths):
+        """
+        Bidirectional breadth-first search. Each side stores only the distance
+        and the parent pointers of the states it has reached; the paths are
+        reconstructed when the searches meet. The paths through a node reached
+        by both searches (a meeting node) are the combinations of its shortest
+        paths from the start and to the end. The meeting nodes are handled in
+        the order of the path length, so the paths come out shortest first, as
+        (categories, path) where categories is the bit mask of the link
+        categories in the path.
+
+        Each category set in passes (each one containing the previous ones)
+        gets at most maxpaths of the paths that it allows. When a set is full
+        the links that only the full sets allow are no longer followed.
+        """
+        start = ('Person', person1handle)
+        end = ('Person', person2handle)
+        selflink = Link("self", (None,None), start)
+        if start == end:
+            yield 0, [selflink]
+            return
+        start = self.dbdata.graph.node_ids.get(start)
+        end = self.dbdata.graph.node_ids.get(end)
+        if start is None or end is None:
+            return  # no links
+
+        # level of each category mask, None if no pass allows it
+        levels = [next((i for i, passmask in enumerate(passes) if mask & ~passmask == 0), None)
+                  for mask in range((EVENTS|NOTES|ASSOCIATIONS) + 1)]
+        maxlevel = len(passes) - 1
+        counts = [0] * len(passes)
+        dist1 = {start: {0: 0}}
+        dist2 = {end: {0: 0}}
+        parents1 = defaultdict(list)
+        parents2 = defaultdict(list)
+        frontier1 = [(start, 0)]
+        frontier2 = [(end, 0)]
+        depth1 = depth2 = 0
+        meetings = []  # (path length, forward state, backward state), longest first
+        found = set()
+        while self.server.running:
+            # expand the smaller frontier by one level
+            if frontier1 and (not frontier2 or len(frontier1) <= len(frontier2)):
+                frontier1 = self.expand(frontier1, depth1, dist1, parents1, levels, maxlevel)
+                depth1 += 1
+                for node, level in frontier1:
+                    for level2, d2 in dist2.get(node, {}).items():
+                        meetings.append((depth1 + d2, (node, level), (node, level2)))
+            else:
+                frontier2 = self.expand(frontier2, depth2, dist2, parents2, levels, maxlevel)
+                depth2 += 1
+                for node, level in frontier2:
+                    for level1, d1 in dist1.get(node, {}).items():
+                        meetings.append((d1 + depth2, (node, level1), (node, level)))
+            meetings.sort(key=lambda item: item[0], reverse=True)
+            exhausted = not frontier1 and not frontier2
+            # a meeting that is not found yet is beyond the depth of a search
+            # that can still go on, so no shorter path can come later
+            depths = [depth for depth, frontier in ((depth1, frontier1), (depth2, frontier2))
+                      if frontier]
+            while meetings and (exhausted or meetings[-1][0] <= min(depths) + 1):
+                _, state1, state2 = meetings.pop()
+                level = max(state1[1], state2[1])
+                if level > maxlevel: continue
+                for path1 in self.paths_from_start(parents1, state1):
+                    for path2 in self.paths_to_end(parents2, state2):
+                        path = [selflink] + path1 + path2
+                        nodes = [link.to_node for link in path]
+                        if len(set(nodes)) != len(nodes): continue  # not a simple path
+                        key = tuple((link.assoc_type, link.to_node) for link in path)
+                        if key in found: continue
+                        found.add(key)
+                        mask = 0
+                        for link in path:
+                            mask |= link.category
+                        yield mask, path
+                        # a path counts for its own pass and all the bigger ones
+                        for i in range(level, maxlevel + 1):
+                            counts[i] += 1
+                        while maxlevel >= 0 and counts[maxlevel] >= maxpaths:
+                            maxlevel -= 1
+                        if maxlevel < 0:
+                            return
+                        if level > maxlevel: break
+                    if level > maxlevel: break
+                if len(passes) - 1 > maxlevel:
+                    frontier1 = [state for state in frontier1 if state[1] <= maxlevel]
+                    frontier2 = [state for state in frontier2 if state[1] <= maxlevel]
+            if exhausted:
+                return
@@ -113,10 +113,13 @@ def get_connections():
     maxpaths = int(request.args["max"][0])
     throttle = bool(request.args["throttle"][0])
     c = connections.VeryDeepConnections(server, dbdata, use_relatives, use_events, use_notes, use_associations, use_places)
-    paths = list(c.generate_paths(handle1, handle2, maxpaths, throttle))
-    paths = connections.fix_paths(paths)
+    tagged_paths = list(c.generate_tagged_paths(handle1, handle2, maxpaths, throttle))
+    paths = connections.fix_paths([path for categories, path in tagged_paths])
+    # the link categories ("events", "notes", "associations") that each path needs
+    categories = {tuple(connections.fix_path(path)): names for names, path in tagged_paths}
     rsp = {
         "paths":paths, 
+        "categories":[categories[path] for path in paths],
         "shortest_path":min((len(path) for path in paths), default=1)-1,
         "longest_path":max((len(path) for path in paths), default=1)-1,
         "refresh_needed": server.refresh_needed,
@@ -19,12 +19,20 @@
 #
 
 
+import collections
+import concurrent.futures
 import csv
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import queue
 import sys
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 from types import GeneratorType
 from gramps.gen.filters._genericfilter import GenericFilterFactory
 from gramps.gen.filters._filterlist import FilterList
@@ -37,23 +45,24 @@ from gramps.gen.lib.place import Place
 from pprint import pprint
 from gramps.gui.display import display_url
 from gramps.gui.utils import ProgressMeter
-from contextlib import contextmanager
 
 try:
     from typing import Any
     from typing import Callable
+    from typing import Deque
     from typing import Dict
     from typing import Generator
     from typing import Iterator
     from typing import List
     from typing import Optional
+    from typing import Set
     from typing import Tuple
     from typing import Type
     from typing import Union
 except:
     pass
 
-from gi.repository import Gtk, Gdk, GObject, Gio
+from gi.repository import Gtk, Gdk, GObject, Gio, GLib
 
 from gramps.gui.glade import Glade
 from gramps.gui.managedwindow import ManagedWindow
@@ -70,6 +79,7 @@ except ValueError:
 _ = _trans.gettext
 
 from gramps.gen.db.txn import DbTxn
+from gramps.gen.errors import HandleError
 
 from gramps.gui.dialog import OkDialog
 
@@ -81,9 +91,74 @@ config.register("defaults.encoding", "utf-8")
 config.register("defaults.delimiter", "comma")
 config.register("defaults.font", "")
 config.register("defaults.last_filename", "")
+config.register("defaults.commit_chunksize", 1000)
 
 SCRIPTFILE_EXTENSION = ".script"
 
+# related objects are prefetched only if the run covers at least this many
+# objects and at least 1/PREFETCH_FRACTION of all objects of the category
+PREFETCH_THRESHOLD = 1000
+PREFETCH_FRACTION = 4
+
+# number of objects read at a time from the selected handles
+FETCH_CHUNKSIZE = 1000
+
+# in the parallel mode each worker process gets this many objects at a time;
+# smaller runs are executed in the main process
+PARALLEL_SHARDSIZE = 500
+PARALLEL_THRESHOLD = 2 * PARALLEL_SHARDSIZE
+# number of shards given to each worker process at a time
+PARALLEL_INFLIGHT = 2
+
+# command line mode: rows are written this many at a time through a buffer
+# of WRITE_BUFFERSIZE bytes
+WRITE_CHUNKSIZE = 1000
+WRITE_BUFFERSIZE = 1024 * 1024
+
+# a query that refers to these names can read any objects; its cached
+# result is dropped when anything in the database changes
+GENERIC_ACCESS_NAMES = {"db", "dbstate", "filter", "env", "uistate", "trans"}
+
+# live update: a change is followed through at most this many references
+# to the objects whose rows are re-evaluated (e.g. place -> event -> person)
+LIVE_UPDATE_DEPTH = 3
+
+# the object types whose change signals are followed by the result cache
+# and the live update
+CHANGE_SIGNAL_NAMESPACES = [
+    "Person",
+    "Family",
+    "Event",
+    "Place",
+    "Citation",
+    "Source",
+    "Repository",
+    "Note",
+    "Media",
+    "Tag",
+]
+
+# the result list is shown in pages of PAGE_SIZE rows; the rows are produced
+# in idle callbacks, at most FETCH_BATCHSIZE rows per callback
+PAGE_SIZE = 1000
+FETCH_BATCHSIZE = 100
+
+# read-only queries are run in a background thread; the window polls for new
+# rows every FETCH_INTERVAL milliseconds
+FETCH_INTERVAL = 50
+
+
+def chunked(rows, size):
+    # type: (Iterator[List[Any]], int) -> Iterator[List[List[Any]]]
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 def get_text(textview):
     buf = textview.get_buffer()
@@ -234,12 +309,27 @@ class GrampsEngine:
         commit_changes,
         summary_only,
         step=None,
+        report=None,
+        all_objects=False,
+        chunksize=FETCH_CHUNKSIZE,
+        processes=0,
+        result_cache=None,
+        profiler=None,
+        commit_chunksize=0,
+        txn_title="SuperTool",
     ):
-        self.dbstate = dbstate
-        self.db = dbstate.db
+        # when changes are committed every read gets a new object, so that
+        # the unsaved changes to one object are not seen through the others
+        if commit_changes:
+            self.db = engine.CachingDb(dbstate.db, maxsize=0)
+        else:
+            self.db = engine.CachingDb(dbstate.db)
+        self.dbstate = engine.RunState(dbstate, self.db)
         self.uistate = uistate
         self.category = category
         self.selected_handles = selected_handles
+        self.object_count = 0
+        self.total_objects = len(selected_handles)
         self.initial_statements = initial_statements
         self.statements = statements
         self.filter = filter
@@ -248,6 +338,27 @@ class GrampsEngine:
         self.commit_changes = commit_changes
         self.summary_only = summary_only
         self.step = step
+        self.report = report  # called with a progress message
+        self.all_objects = all_objects
+        self.chunksize = chunksize
+        self.processes = processes
+        self.result_cache = result_cache
+        self.cached = False
+        self.cancelled = False
+        self.commit_count = 0
+        self.init_env = None  # type: Optional[Dict[str,Any]]
+        self.profiler = profiler
+        self.commit_chunksize = commit_chunksize
+        self.txn_title = txn_title
+        self.trans = None
+        # set by compile_scripts; a cached result or the background thread
+        # may provide the rows without compiling the scripts in this engine
+        self.compiled = False
+        self.initial_code = None
+        self.statements_code = None
+        self.filter_code = None
+        self.expressions_code = None
+        self.filter_first = False
 
     def generate_rows(self, res):
         # type: (Tuple[Any,...]) -> Iterator[List[Any]]
@@ -257,89 +368,659 @@ class GrampsEngine:
             else:
                 return str(value)
 
-        if not res:
-            yield []
-            return
-        value = res[0]
-        for values in self.generate_rows(res[1:]):
+        columns = []
+        for value in res:
             if type(value) is GeneratorType:
                 value = list(value)
             if self.unwind_lists and type(value) is list:
-                for v in value:
-                    yield [cast(v)] + values
+                columns.append([cast(v) for v in value])
             else:
-                yield [cast(value)] + values
+                columns.append([cast(value)])
+        # the first column varies fastest
+        for values in itertools.product(*reversed(columns)):
+            yield list(reversed(values))
+
+    def compile_scripts(self):
+        # type: () -> None
+        # compile everything once per run; the code objects are then
+        # used for every object
+        self.initial_code = None
+        self.statements_code = None
+        self.filter_code = None
+        self.expressions_code = None
+        self.filter_first = False
+        if self.initial_statements:
+            self.initial_code = engine.compile_code(self.initial_statements, "exec")
+        if self.statements:
+            self.statements_code = engine.compile_code(self.statements, "exec")
+        if self.filter:
+            self.filter_code = engine.compile_code(self.filter)
+        if self.expressions:
+            self.expressions_code = engine.compile_code(self.expressions)
+        self.compiled = True
+        # the statements need to be executed only for the objects that the
+        # filter accepts if they cannot affect the filter result
+        self.filter_first = bool(
+            self.statements
+            and self.filter
+            and not self.commit_changes
+            and engine.can_filter_first(
+                self.statements, self.filter, self.initial_statements
+            )
+        )
+
+    def prefetch(self):
+        # type: () -> None
+        # read in the related objects that the query refers to with one
+        # pass over each table instead of separate reads for every object
+        if not self.category.objclass or self.commit_changes:
+            return
+        count = len(self.selected_handles)
+        if count < PREFETCH_THRESHOLD:
+            return
+        if count * PREFETCH_FRACTION < self.category.get_count_func():
+            return
+        paths = self.find_attribute_paths(include_initial=False)
+        namespaces = engine.get_prefetch_namespaces(paths, self.category.proxyclass)
+        for namespace in sorted(namespaces):
+            self.db.prefetch(namespace)
+
+    def find_attribute_paths(self, include_initial=True):
+        # type: (bool) -> Set[Tuple[Optional[str],...]]
+        scripts = [
+            (self.statements, "exec"),
+            (self.filter, None),
+            (self.expressions, None),
+        ]
+        if include_initial:
+            scripts.append((self.initial_statements, "exec"))
+        paths = set()
+        for code, exectype in scripts:
+            if code:
+                paths |= engine.find_attribute_paths(code, exectype)
+        return paths
+
+    def get_dependencies(self):
+        # type: () -> Optional[List[str]]
+        # the object types (namespaces) that the query reads; None if the
+        # query can read anything
+        paths = self.find_attribute_paths()
+        if any(path[0] in GENERIC_ACCESS_NAMES for path in paths):
+            return None
+        namespaces = engine.get_prefetch_namespaces(paths, self.category.proxyclass)
+        namespaces.add("Tag")
+        if self.category.objclass:
+            namespaces.add(self.category.objclass)
+        return sorted(namespaces)
+
+    def get_cache_key(self):
+        # type: () -> str
+        selection = hashlib.sha256(
+            "\n".join(self.selected_handles).encode("utf-8")
+        ).hexdigest()
+        return self.result_cache.get_key(
+            self.category.category_name,
+            selection,
+            engine.process_includes(self.initial_statements),
+            engine.process_includes(self.statements),
+            self.filter,
+            self.expressions,
+            self.unwind_lists,
+            self.summary_only,
+        )
+
+    def get_commit_summary(self):
+        # type: () -> str
+        if not self.commit_changes:
+            return ""
+        return "; committed: {}".format(self.commit_count)
+
+    def get_cache_summary(self):
+        # type: () -> str
+        if self.cached:
+            return "; cached result"
+        hit_rate = self.db.hit_rate()
+        if hit_rate is None:
+            return ""
+        return "; cache hits: {:.0%} of {}".format(
+            hit_rate, self.db.hits + self.db.misses
+        )
 
     def evaluate_condition(self, obj, cond, env):
-        # type: (Any,str,Dict[str,Any]) -> Tuple[bool, Dict[str,Any]]
+        # type: (Any,Any,Dict[str,Any]) -> Tuple[bool, Dict[str,Any]]
         return self.category.execute_func(self.dbstate, obj, cond, env)
 
+    def iter_objects(self):
+        # type: () -> Iterator[Tuple[str,Any]]
+        if self.all_objects and not self.commit_changes:
+            # one pass over the whole table; the cursor is not used if
+            # objects are committed during the run
+            for obj in self.category.iter_objects_func():
+                yield obj.handle, obj
+            return
+        getfunc = self.category.getfunc
+        handles = self.selected_handles
+        for i in range(0, len(handles), self.chunksize):
+            chunk = handles[i : i + self.chunksize]
+            # read each chunk in key order but process it in the original order;
+            # the objects are read from the database and not through the cache
+            # so that the changes that the statements make but do not commit
+            # are not seen when the object is referred to from other objects
+            objects = {handle: getfunc(handle) for handle in sorted(chunk)}
+            for handle in chunk:
+                yield handle, objects[handle]
+
     def generate_values(self, init_env):
         # type: (Dict[str,Any]) -> Iterator[Tuple[Any,Dict[str,Any],List[Any]]]
         self.total_objects = len(self.selected_handles)
-        for handle in self.selected_handles:
+        objects = self.iter_objects()
+        if self.profiler:
+            objects = self.profiler.timed("fetch", objects)
+        if self.commit_changes and self.commit_chunksize:
+            yield from self.generate_values_in_batches(objects, init_env)
+            return
+        for handle, obj in objects:
             if self.step:
                 if self.step():
-                    raise StopIteration()
-            env = {}
-            env.update(init_env)
-            obj = self.category.getfunc(handle)
-            obj.commit_ok = True
-            if self.statements:
-                value, env = self.category.execute_func(
-                    self.dbstate, obj, self.statements, env, "exec"
-                )
+                    self.cancelled = True
+                    return
+            for env, values in self.evaluate_object(handle, obj, init_env):
+                yield obj, env, values
+
+    def generate_values_in_batches(self, objects, init_env):
+        # type: (Iterator[Tuple[str,Any]], Dict[str,Any]) -> Iterator[Tuple[Any,Dict[str,Any],List[Any]]]
+        # each chunk of objects is committed in its own batch transaction so
+        # that the transaction does not grow without limit
+        done = 0
+        for chunk in chunked(objects, self.commit_chunksize):
+            with DbTxn(self.txn_title, self.db.db, batch=True) as trans:
+                self.trans = trans
+                init_env["trans"] = trans
+                for handle, obj in chunk:
+                    if self.step:
+                        if self.step():
+                            # the objects processed so far are committed
+                            self.cancelled = True
+                            return
+                    for env, values in self.evaluate_object(handle, obj, init_env):
+                        yield obj, env, values
+            done += len(chunk)
+            if self.report:
+                self.report("Committed {}/{} objects".format(done, self.total_objects))
+
+    def evaluate_object(self, handle, obj, init_env):
+        # type: (str, Any, Dict[str,Any]) -> Iterator[Tuple[Dict[str,Any],List[Any]]]
+        profiler = self.profiler
+        if profiler:
+            t = time.perf_counter()
+        env = {}
+        env.update(init_env)
+        obj.commit_ok = True
+        if self.commit_changes:
+            # objects that the statements did not change are not written
+            original = obj.serialize()
+        if self.filter_code and self.filter_first:
+            ok, env = self.evaluate_condition(obj, self.filter_code, env)
+            if profiler:
+                t = profiler.lap("filter", t)
+            if not ok:
+                return
 
-            if self.filter:
-                ok, env = self.evaluate_condition(obj, self.filter, env)
-                if not ok:
-                    continue
+        if self.statements_code:
+            value, env = self.category.execute_func(
+                self.dbstate, obj, self.statements_code, env, "exec"
+            )
+            if profiler:
+                t = profiler.lap("statements", t)
+
+        if self.filter_code and not self.filter_first:
+            ok, env = self.evaluate_condition(obj, self.filter_code, env)
+            if profiler:
+                t = profiler.lap("filter", t)
+            if not ok:
+                return
 
-            if self.commit_changes and obj.commit_ok:
+        if self.commit_changes and obj.commit_ok:
+            if obj.serialize() != original:
                 self.category.commitfunc(obj, self.trans)
+                self.db.invalidate(self.category.objclass, handle)
+                self.commit_count += 1
+            if profiler:
+                t = profiler.lap("commit", t)
+
+        self.object_count += 1
+        if self.expressions_code:
+            res, env = self.category.execute_func(
+                self.dbstate, obj, self.expressions_code, env
+            )
+            if profiler:
+                profiler.lap("expressions", t)
+            if type(res) != tuple:
+                res = (res,)
+            rows = self.generate_rows(res)
+            if profiler:
+                rows = profiler.timed("rows", rows)
+            for values in rows:
+                values.append(handle)
+                yield env, [obj.gramps_id] + values
+
+    def can_update_live(self):
+        # type: () -> bool
+        # rows can be patched object by object only if each object's rows
+        # depend on known types of objects
+        return (
+            self.category.objclass is not None
+            and not self.commit_changes
+            and not self.summary_only
+            and self.get_dependencies() is not None
+        )
 
-            self.object_count += 1
-            if self.expressions:
-                res, env = self.category.execute_func(
-                    self.dbstate, obj, self.expressions, env
-                )
-                if type(res) != tuple:
-                    res = (res,)
-                for values in self.generate_rows(res):
-                    values.append(handle)
-                    yield obj, env, [obj.gramps_id] + values
+    def find_affected_handles(self, namespace, handles):
+        # type: (str, List[str]) -> Set[str]
+        # the objects of the category type whose rows may change when the
+        # given objects of type 'namespace' change: follow the back references
+        # through the object types the query reads; the objects that the
+        # changed objects refer to are included too because of attributes
+        # like 'participants' that are computed from back references
+        target = self.category.objclass
+        namespaces = set(self.get_dependencies())
+        realdb = self.db.db
+        affected = set()
+        for handle in handles:
+            try:
+                obj = realdb.get_from_name_and_handle(namespace, handle)
+            except HandleError:
+                continue  # deleted
+            if obj:
+                for objclass, ref in obj.get_referenced_handles_recursively():
+                    if objclass == target:
+                        affected.add(ref)
+        level = {(namespace, handle) for handle in handles}
+        seen = set(level)
+        for depth in range(LIVE_UPDATE_DEPTH + 1):
+            nextlevel = set()
+            for objclass, handle in level:
+                if objclass == target:
+                    affected.add(handle)
+                if depth == LIVE_UPDATE_DEPTH:
+                    continue
+                for ref in realdb.find_backlink_handles(handle):
+                    if ref[0] in namespaces and ref not in seen:
+                        seen.add(ref)
+                        nextlevel.add(ref)
+            level = nextlevel
+        return affected
+
+    def evaluate_handles(self, handles):
+        # type: (List[str]) -> Dict[str,List[List[Any]]]
+        # evaluates the given objects again after they have changed and
+        # returns their new rows; a deleted object has no rows
+        if not self.compiled:
+            self.compile_scripts()
+        if self.init_env is None:  # the parallel mode did not initialize
+            self.init_env = self.run_initial_statements(self.trans)
+        namespace = self.category.objclass
+        object_count = self.object_count
+        rows = {}
+        for handle in handles:
+            rows[handle] = []
+            self.db.invalidate(namespace, handle)
+            try:
+                obj = self.category.getfunc(handle)  # not through the cache
+            except HandleError:
+                continue
+            if obj is None:
+                continue
+            for env, values in self.evaluate_object(handle, obj, self.init_env):
+                rows[handle].append(values)
+        self.object_count = object_count
+        return rows
 
-    def get_values(self, trans):
-        # type: () -> None
-        print("executing")
+    def initialize(self, trans):
+        # type: (Any) -> Dict[str,Any]
         self.trans = trans
 
         #         if not self.category.execute_func:
         #             return
         self.object_count = 0
+        self.commit_count = 0
+        t = time.perf_counter()
+        self.compile_scripts()
+        self.prefetch()
+        if self.profiler:
+            t = self.profiler.lap("prefetch", t)
+        self.init_env = self.run_initial_statements(trans)
+        if self.profiler:
+            self.profiler.lap("initial statements", t)
+        return self.init_env
+
+    def run_initial_statements(self, trans):
+        # type: (Any) -> Dict[str,Any]
         init_env = {}  # type: Dict[str,Any]
         init_env["trans"] = trans
         init_env["uistate"] = self.uistate
-        if self.initial_statements:
+        if self.initial_code:
             value, init_env = self.category.execute_func(
-                self.dbstate, None, self.initial_statements, init_env, "exec"
+                self.dbstate, None, self.initial_code, init_env, "exec"
             )
+        return init_env
+
+    def use_parallel(self):
+        # type: () -> bool
+        # only read-only queries that produce rows independently for each
+        # object can be split between processes; the worker processes open
+        # the database like the background thread does, and they are not
+        # forked from the background thread
+        return (
+            self.processes > 1
+            and self.category.objclass is not None
+            and not self.commit_changes
+            and not self.summary_only
+            and len(self.selected_handles) >= PARALLEL_THRESHOLD
+            and "fork" in multiprocessing.get_all_start_methods()
+            and self.profiler is None
+            and threading.current_thread() is threading.main_thread()
+            and can_run_in_background(self.db)
+        )
+
+    def get_values_parallel(self):
+        # type: () -> Iterator[List[Any]]
+        handles = self.selected_handles
+        self.total_objects = len(handles)
+        shards = (
+            (i, min(i + PARALLEL_SHARDSIZE, len(handles)))
+            for i in range(0, len(handles), PARALLEL_SHARDSIZE)
+        )
+        args = dict(
+            selected_handles=handles,
+            initial_statements=self.initial_statements,
+            statements=self.statements,
+            filter=self.filter,
+            expressions=self.expressions,
+            unwind_lists=self.unwind_lists,
+            commit_changes=False,
+            summary_only=False,
+            chunksize=self.chunksize,
+        )
+        dirpath = self.db.get_save_path()
+        executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=parallel_init,
+            initargs=(dirpath, self.category.category_name, args),
+        )
+        # only a few shards are submitted at a time so that the rows are not
+        # computed much ahead of the caller; the results are handled in the
+        # original order
+        pending = collections.deque()  # type: Deque[Tuple[Tuple[int,int],Any]]
+
+        def submit(count):
+            for shard in itertools.islice(shards, count):
+                pending.append((shard, executor.submit(parallel_run, shard)))
 
+        try:
+            submit(PARALLEL_INFLIGHT * self.processes)
+            while pending:
+                (start, end), future = pending.popleft()
+                count, rows = future.result()  # raises an error of the worker
+                submit(1)
+                self.object_count += count
+                for values in rows:
+                    yield values
+                if self.step:
+                    for _ in range(start, end):
+                        if self.step():
+                            self.cancelled = True
+                            return
+        finally:
+            for shard, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @contextmanager
+    def profiling(self):
+        # the property timings are collected only while the code runs inside
+        # this context; the proxy classes are shared with other code (e.g.
+        # the generic filter rules)
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.install()
+        try:
+            yield
+        finally:
+            self.profiler.uninstall()
+
+    def get_values(self, trans):
+        # type: (Any) -> Iterator[List[Any]]
+        self.cached = False
+        if self.result_cache is None or self.commit_changes:
+            yield from self.compute_values(trans)
+            return
+        key = self.get_cache_key()
+        cached = self.result_cache.get(key)
+        if cached:
+            header, rows = cached
+            self.cached = True
+            self.object_count = header["object_count"]
+            self.total_objects = header["total_objects"]
+            yield from rows
+            return
+
+        marker = self.result_cache.get_marker()
+        header = {}  # type: Dict[str,Any]
+
+        def compute_rows():
+            yield from self.compute_values(trans)
+            header["object_count"] = self.object_count
+            header["total_objects"] = self.total_objects
+
+        yield from self.result_cache.put(
+            key, marker, self.get_dependencies(), header, compute_rows()
+        )
+
+    def compute_values(self, trans):
+        # type: (Any) -> Iterator[List[Any]]
+        print("executing", file=sys.stderr)
+        if self.use_parallel():
+            self.trans = trans
+            self.object_count = 0
+            self.compile_scripts()  # report syntax errors before starting
+            yield from self.get_values_parallel()
+            return
+
+        init_env = self.initialize(trans)
         for obj, env, values in self.generate_values(init_env):
             if not self.summary_only:
                 yield values
 
         if self.summary_only:
-            if self.expressions:
+            if self.expressions_code:
+                t = time.perf_counter()
                 res, env = self.category.execute_func(
-                    self.dbstate, None, self.expressions, init_env
+                    self.dbstate, None, self.expressions_code, init_env
                 )
+                if self.profiler:
+                    self.profiler.lap("expressions", t)
                 if type(res) != tuple:
                     res = (res,)
                 for values in self.generate_rows(res):
                     yield [None] + values + [None]
 
 
+# state of a worker process in the parallel mode
+worker_engine = None  # type: Optional[GrampsEngine]
+worker_init_env = {}  # type: Dict[str,Any]
+worker_error = None  # type: Optional[Exception]
+
+
+def parallel_init(dirpath, category_name, args):
+    # type: (str, str, Dict[str,Any]) -> None
+    # each worker opens its own read-only connection to the database
+    global worker_engine, worker_init_env, worker_error
+    from gramps.gen.db import DBMODE_R
+    from gramps.gen.db.utils import make_database, get_dbid_from_path
+
+    try:
+        db = make_database(get_dbid_from_path(dirpath))
+        db.load(dirpath, None, DBMODE_R)
+        dbstate = types.SimpleNamespace(db=db)
+        category = engine.get_category_info(db, category_name)
+        worker_engine = GrampsEngine(dbstate, None, category, **args)
+        worker_init_env = worker_engine.initialize(None)
+    except Exception as e:
+        # raised from parallel_run so that the run stops with this error
+        # instead of a broken pool
+        worker_error = e
+
+
+def parallel_run(shard):
+    # type: (Tuple[int,int]) -> Tuple[int,List[List[Any]]]
+    if worker_error is not None:
+        raise worker_error
+    start, end = shard
+    all_handles = worker_engine.selected_handles
+    worker_engine.selected_handles = all_handles[start:end]
+    worker_engine.object_count = 0
+    try:
+        rows = [
+            values
+            for obj, env, values in worker_engine.generate_values(worker_init_env)
+        ]
+    finally:
+        worker_engine.selected_handles = all_handles
+    return worker_engine.object_count, rows
+
+
+def can_run_in_background(db):
+    # type: (Any) -> bool
+    # the background thread opens its own read-only connection to the
+    # database, like the worker processes of the parallel mode; this is not
+    # done for BSDDB databases
+    from gramps.gen.db.utils import get_dbid_from_path
+
+    dirpath = db.get_save_path()
+    if not dirpath or not os.path.isdir(dirpath):
+        return False
+    return get_dbid_from_path(dirpath) not in (None, "bsddb")
+
+
+class RowProducer(threading.Thread):
+    """
+    Runs a read-only query in a background thread and passes the rows to the
+    window through a queue. The queue holds at most one page of rows so the
+    query is evaluated only one page ahead of what has been shown. The
+    query can be paused, resumed and cancelled; rows produced before the
+    cancellation are still delivered.
+    """
+
+    def __init__(self, dirpath, category_name, args):
+        # type: (str, str, Dict[str,Any]) -> None
+        threading.Thread.__init__(self, name="SuperTool", daemon=True)
+        self.dirpath = dirpath
+        self.category_name = category_name
+        self.args = args
+        self.engine = None  # type: Optional[GrampsEngine]
+        self.rows = queue.Queue(PAGE_SIZE)  # type: queue.Queue
+        self.running = threading.Event()
+        self.running.set()
+        self.cancelled = False
+        self.finished = False
+        self.error = None  # type: Optional[Exception]
+        self.steps = 0
+        self.started = time.time()
+        self.stopped = None  # type: Optional[float]
+        self.waited = 0.0
+
+    def run(self):
+        # type: () -> None
+        from gramps.gen.db import DBMODE_R
+        from gramps.gen.db.utils import make_database, get_dbid_from_path
+
+        db = None
+        try:
+            db = make_database(get_dbid_from_path(self.dirpath))
+            db.load(self.dirpath, None, DBMODE_R)
+            dbstate = types.SimpleNamespace(db=db)
+            category = engine.get_category_info(db, self.category_name)
+            self.engine = GrampsEngine(
+                dbstate, None, category, step=self.step, **self.args
+            )
+            for values in self.engine.get_values(None):
+                if not self.put(values):
+                    break
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+        finally:
+            if db:
+                db.close()
+            self.stopped = time.time()
+            self.finished = True
+
+    def step(self):
+        # type: () -> bool
+        # called by the engine for every object; blocks while paused
+        self.steps += 1
+        if not self.running.is_set():
+            t1 = time.time()
+            self.running.wait()
+            self.waited += time.time() - t1
+        return self.cancelled
+
+    def put(self, values):
+        # type: (List[Any]) -> bool
+        t1 = time.time()
+        try:
+            while not self.cancelled:
+                try:
+                    self.rows.put(values, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.waited += time.time() - t1
+
+    def get_rows(self, count, timeout=None):
+        # type: (int, Optional[float]) -> List[List[Any]]
+        # returns at most count rows that are ready; waits for the first row
+        # at most timeout seconds
+        rows = []
+        try:
+            if timeout is not None:
+                rows.append(self.rows.get(timeout=timeout))
+            while len(rows) < count:
+                rows.append(self.rows.get_nowait())
+        except queue.Empty:
+            pass
+        return rows
+
+    def get_elapsed(self):
+        # type: () -> float
+        # the time spent on the query, excluding the time waiting for the
+        # window to take the rows and the pauses
+        end = self.stopped or time.time()
+        return end - self.started - self.waited
+
+    def paused(self):
+        # type: () -> bool
+        return not self.running.is_set()
+
+    def pause(self):
+        # type: () -> None
+        self.running.clear()
+
+    def resume(self):
+        # type: () -> None
+        self.running.set()
+
+    def cancel(self):
+        # type: () -> None
+        self.cancelled = True
+        self.running.set()
+
+
 class Query:
     def __init__(self):
         self.category = ""
@@ -352,6 +1033,7 @@ class Query:
         self.unwind_lists = False
         self.commit_changes = False
         self.summary_only = False
+        self.cache_results = False
 
 
 class ScriptFile:
@@ -378,9 +1060,11 @@ class ScriptFile:
         unwind_lists = data.get("unwind_lists", "")
         commit_changes = data.get("commit_changes", "")
         summary_only = data.get("summary_only", "")
+        cache_results = data.get("cache_results", "")
         query.unwind_lists = unwind_lists == "True"
         query.commit_changes = commit_changes == "True"
         query.summary_only = summary_only == "True"
+        query.cache_results = cache_results == "True"
         return query
 
     def save(self, filename, query):
@@ -398,6 +1082,7 @@ class ScriptFile:
         data["unwind_lists"] = str(query.unwind_lists)
         data["commit_changes"] = str(query.commit_changes)
         data["summary_only"] = str(query.summary_only)
+        data["cache_results"] = str(query.cache_results)
 
         self.__writedata(filename, data)
 
@@ -462,6 +1147,28 @@ class HelpWindow(Gtk.Window):
         self.box.pack_start(help_notebook, True, True, 0)
 
 
+class ProfileWindow(Gtk.Window):
+    def __init__(self):
+        Gtk.Window.__init__(self, title="SuperTool profile")
+        self.set_default_size(500, 400)
+        self.connect("delete-event", self.__hide)
+        scrolled_window = Gtk.ScrolledWindow()
+        self.add(scrolled_window)
+        self.textview = Gtk.TextView()
+        self.textview.set_editable(False)
+        self.textview.set_monospace(True)
+        scrolled_window.add(self.textview)
+
+    def set_report(self, text):
+        # type: (str) -> None
+        self.textview.get_buffer().set_text(text)
+
+    def __hide(self, *args):
+        # the window is reused for the next run
+        self.hide()
+        return True
+
+
 class SuperTool(ManagedWindow):
     def __init__(self, user, dbstate):
         ManagedWindow.__init__(self, user.uistate, [], self.__class__, modal=False)
@@ -474,6 +1181,23 @@ class SuperTool(ManagedWindow):
         self.getfunc = None
         self.execute_func = None
         self.editfunc = None
+        self._progress = None
+        self.gramps_engine = None
+        self.rows_iter = None
+        self.producer = None  # type: Optional[RowProducer]
+        self.result_rows = []  # type: List[List[Any]]
+        self.rows_pending = False
+        self.page = 0
+        self.steps = 0
+        self.elapsed = 0.0
+        self.fetch_id = None
+        self.live_handles = set()  # type: Set[str]
+        self.pending_updates = set()  # type: Set[str]
+        self.updated_handles = set()  # type: Set[str]
+        self.skipped_handles = set()  # type: Set[str]
+        self.object_count_delta = 0
+        self.dbstate_signal_keys = []  # type: List[Any]
+        self.db_signal_keys = []  # type: List[Tuple[Any,Any]]
         self.init()
 
     def init(self):
@@ -482,8 +1206,11 @@ class SuperTool(ManagedWindow):
         self.select_category()
         self.loadconfig()
         # self.load_attributes()
-        self.dbstate.connect("no-database", self.db_closed)
-        self.dbstate.connect("database-changed", self.db_changed)
+        self.dbstate_signal_keys = [
+            self.dbstate.connect("no-database", self.db_closed),
+            self.dbstate.connect("database-changed", self.db_changed),
+        ]
+        self.connect_db_signals()
         self.uistate.viewmanager.notebook.connect("switch-page", self.pageswitch)
         print(self.uistate.viewmanager.active_page)
         self.set_window(window, None, _("SuperTool"))
@@ -504,6 +1231,7 @@ class SuperTool(ManagedWindow):
     def db_closed(self):
         # type: () -> None
         print("db_closed")
+        self.__stop_fetching()
         if self.listview:
             self.output_window.remove(self.listview)
         self.listview = None  # type: Optional[Gtk.TreeView]
@@ -511,44 +1239,118 @@ class SuperTool(ManagedWindow):
 
     def db_changed(self, db):
         # type: (Any) -> None
+        self.__cancel_run()
         self.db = self.dbstate.db
         print("db_changed", db, db.db_is_open)
         print("db:", self.dbstate.db)
         print("db is_open:", self.dbstate.db.db_is_open)
         if db.db_is_open:
             self.btn_execute.set_sensitive(True)
+        self.connect_db_signals()
         self.statusmsg.set_text("")
         self.select_category()
 
+    def connect_db_signals(self):
+        # type: () -> None
+        # keep the cached query results that do not depend on the changed
+        # object type and patch the displayed rows (live update)
+        self.disconnect_db_signals()
+        self.result_cache = engine.ResultCache(self.db)
+        for namespace in CHANGE_SIGNAL_NAMESPACES:
+            for action in ["add", "update", "delete"]:
+                signal = namespace.lower() + "-" + action
+                key = self.db.connect(signal, self.__make_change_callback(namespace, action))
+                self.db_signal_keys.append((self.db, key))
+
+    def disconnect_db_signals(self):
+        # type: () -> None
+        for db, key in self.db_signal_keys:
+            try:
+                db.disconnect(key)
+            except Exception:  # the database may already be closed
+                pass
+        self.db_signal_keys = []
+
+    def __make_change_callback(self, namespace, action):
+        # type: (str, str) -> Callable[[List[str]],None]
+        def callback(handles):
+            if self.cache_checkbox.get_active():
+                # otherwise the cached results are just invalidated by the
+                # database marker
+                self.result_cache.changed(namespace)
+            self.__live_update(namespace, action, handles)
+
+        return callback
+
+    def __live_update(self, namespace, action, handles):
+        # type: (str, str, List[str]) -> None
+        if not self.live_checkbox.get_active() or self.gramps_engine is None:
+            return
+        if not self.gramps_engine.can_update_live():
+            return
+        for handle in handles:
+            self.gramps_engine.db.invalidate(namespace, handle)
+        if namespace == self.category.objclass:
+            if action == "add" and self.gramps_engine.all_objects:
+                self.live_handles.update(handles)
+            elif action == "delete":
+                self.live_handles.difference_update(handles)
+                self.pending_updates.update(handles)  # rows are removed
+        try:
+            affected = self.gramps_engine.find_affected_handles(namespace, handles)
+        except Exception as e:
+            self.__handle_exception(e)
+            return
+        self.pending_updates.update(affected & self.live_handles)
+        self.__apply_live_updates()
+
+    def __apply_live_updates(self):
+        # type: () -> None
+        # replaces the rows of the changed objects; the rows of an object that
+        # did not have rows before are added at the end. The rows that are
+        # still to come from the result stream are dropped for these objects
+        # (see __skip_updated), so the updates do not wait for the user to
+        # fetch all pages
+        handles = sorted(self.pending_updates)
+        self.pending_updates = set()
+        if not handles:
+            return
+        if self.rows_pending:
+            self.updated_handles.update(handles)
+        t1 = time.time()
+        try:
+            new_rows = self.gramps_engine.evaluate_handles(handles)
+        except Exception as e:
+            self.__handle_exception(e)
+            return
+        rows = []
+        old_matches = set()
+        for values in self.result_rows:
+            handle = values[-1]
+            if handle in new_rows:
+                if handle not in old_matches:
+                    old_matches.add(handle)
+                    rows.extend(new_rows[handle])
+            else:
+                rows.append(values)
+        new_matches = {handle for handle in handles if new_rows[handle]}
+        for handle in handles:
+            if handle not in old_matches:
+                rows.extend(new_rows[handle])
+        self.object_count_delta += len(new_matches) - len(old_matches)
+        self.result_rows = rows
+        self.elapsed += time.time() - t1
+        lastpage = max(0, (len(rows) - 1) // PAGE_SIZE)
+        self.__show_page(min(self.page, lastpage))
+
     def get_configfile(self):
         # type: () -> str
         return __file__[:-3] + "-" + self.category_name + SCRIPTFILE_EXTENSION
 
     def get_attributes(self, objclass, proxyclass):
-        obj = objclass()
-        for name in dir(obj):
-            if name.startswith("_"):
-                continue
-            attr = getattr(obj, name)
-            #             if type(attr) == types.FunctionType: continue
-            if type(attr) == types.MethodType:
-                continue
-            # print(name, type(attr))
-            # self.attributes_list.append_text(name)
-        from unittest import mock
-
-        db = mock.Mock()
-        obj = mock.Mock()
-        p = proxyclass(db, obj.handle, obj)
-
-        for name in dir(proxyclass) + list(
-            p.__dict__.keys()
-        ):  # this contains the @property methods
-            if name.startswith("_"):
-                continue
-            # print(">>",name)
-            # print(name, type(attr))
-            yield name
+        # type: (Any, Any) -> Iterator[str]
+        # the properties and the slots of the proxy class
+        return iter(engine.get_attribute_names(proxyclass))
 
     def set_error(self, msg):
         # type: (str) -> None
@@ -589,13 +1391,14 @@ class SuperTool(ManagedWindow):
 
     def pageswitch(self, *args):
         # type: (Any) -> None
+        self.__stop_fetching()
         self.saveconfig()
         self.select_category()
         self.loadconfig()
         if self.listview:
             self.output_window.remove(self.listview)
-            self.btn_csv.hide()
-            self.btn_copy.hide()
+            self.listview = None
+            self.__hide_result_buttons()
         self.statusmsg.set_text("")
         self.check_category()
 
@@ -619,6 +1422,7 @@ class SuperTool(ManagedWindow):
         query.unwind_lists = self.unwind_lists.get_active()
         query.commit_changes = self.commit_checkbox.get_active()
         query.summary_only = self.summary_checkbox.get_active()
+        query.cache_results = self.cache_checkbox.get_active()
 
         scriptfile = ScriptFile()
         scriptfile.save(filename, query)
@@ -654,6 +1458,7 @@ class SuperTool(ManagedWindow):
         self.unwind_lists.set_active(query.unwind_lists)
         self.commit_checkbox.set_active(query.commit_changes)
         self.summary_checkbox.set_active(query.summary_only)
+        self.cache_checkbox.set_active(query.cache_results)
 
     def saveconfig(self):
         # type: () -> None
@@ -703,14 +1508,19 @@ class SuperTool(ManagedWindow):
                 config.set("defaults.delimiter", delimiter)
                 config.save()
 
-                writer = csv.writer(
-                    open(self.csv_filename, "w", encoding=encoding, newline=""),
-                    delimiter=delimiter,
-                )
-                for row in self.store:
-                    for col in row:
-                        print("- col", col)
-                    writer.writerow(row)
+                # the file gets all rows of the result, not just the
+                # current page
+                try:
+                    self.__fetch_all()
+                except Exception as e:
+                    self.__handle_exception(e)
+                    break
+                self.__show_page(self.page)
+                with open(
+                    self.csv_filename, "w", encoding=encoding, newline=""
+                ) as f:
+                    writer = csv.writer(f, delimiter=delimiter)
+                    writer.writerows(self.result_rows)
                 break
 
         choose_file_dialog.destroy()
@@ -805,6 +1615,7 @@ class SuperTool(ManagedWindow):
         self.unwind_lists.set_active(False)
         self.commit_checkbox.set_active(False)
         self.summary_checkbox.set_active(False)
+        self.cache_checkbox.set_active(False)
 
     def __close(self, obj):
         self.saveconfig()
@@ -812,6 +1623,17 @@ class SuperTool(ManagedWindow):
             self.help_win.close()
         self.close()
 
+    def close(self, *obj):
+        self.__cancel_run()
+        self.disconnect_db_signals()
+        for key in self.dbstate_signal_keys:
+            self.dbstate.disconnect(key)
+        self.dbstate_signal_keys = []
+        if self.profile_win:
+            self.profile_win.destroy()
+            self.profile_win = None
+        ManagedWindow.close(self, *obj)
+
     def build_help(self):  # temporary helper; not used
         self.help_notebook = Gtk.Notebook()
         page = 0
@@ -907,10 +1729,18 @@ class SuperTool(ManagedWindow):
         self.unwind_lists = glade.get_child_object("unwind_lists")
         self.commit_checkbox = glade.get_child_object("commit_checkbox")
         self.summary_checkbox = glade.get_child_object("summary_checkbox")
+        self.parallel_checkbox = glade.get_child_object("parallel_checkbox")
+        self.live_checkbox = glade.get_child_object("live_checkbox")
+        self.profile_checkbox = glade.get_child_object("profile_checkbox")
+        self.batch_checkbox = glade.get_child_object("batch_checkbox")
+        self.cache_checkbox = glade.get_child_object("cache_checkbox")
 
         self.btn_execute = glade.get_child_object("btn_execute")
         self.btn_csv = glade.get_child_object("btn_csv")
         self.btn_copy = glade.get_child_object("btn_copy")
+        self.btn_prev_page = glade.get_child_object("btn_prev_page")
+        self.btn_next_page = glade.get_child_object("btn_next_page")
+        self.btn_pause = glade.get_child_object("btn_pause")
         self.btn_close = glade.get_child_object("btn_close")
         self.btn_load = glade.get_child_object("btn_load")
         self.btn_save = glade.get_child_object("btn_save")
@@ -930,11 +1760,15 @@ class SuperTool(ManagedWindow):
         self.help_window = glade.get_object("help_window")
         self.help_notebook = glade.get_object("help_notebook")
         self.help_win = None
+        self.profile_win = None
 
         self.selected_objects.set_active(True)
         self.btn_execute.connect("clicked", self.__execute)
         self.btn_csv.connect("clicked", self.download)
         self.btn_copy.connect("clicked", self.copy)
+        self.btn_prev_page.connect("clicked", self.prev_page)
+        self.btn_next_page.connect("clicked", self.next_page)
+        self.btn_pause.connect("clicked", self.pause_resume)
         self.btn_close.connect("clicked", self.__close)
         self.btn_load.connect("clicked", self.load)
         self.btn_save.connect("clicked", self.save)
@@ -972,10 +1806,10 @@ class SuperTool(ManagedWindow):
 
     def __execute(self, obj):
         # type: (Gtk.Widget) -> None
+        self.__cancel_run()
         self.statusmsg.set_text("")
         self.output_window.hide()
-        self.btn_csv.hide()
-        self.btn_copy.hide()
+        self.__hide_result_buttons()
         self.trans = None
         try:
             self.commit_changes = self.commit_checkbox.get_active()
@@ -983,26 +1817,31 @@ class SuperTool(ManagedWindow):
             if self.title.get_text():
                 txtitle += " ({})".format(self.title.get_text())
 
-            if self.commit_changes:
+            self.txtitle = txtitle
+            if self.commit_changes and not self.batch_checkbox.get_active():
                 with DbTxn(txtitle, self.dbstate.db) as self.trans:
                     self.__execute1()
-            else:  # no need for a transaction
+            else:  # no transaction or one per batch (opened by GrampsEngine)
                 self.__execute1()
         except Exception as e:
-            traceback.print_exc()
-            if isinstance(e, engine.SupertoolException):
-                self.set_error(str(e))
-                return
-            lines = traceback.format_exc().splitlines()
-            lastline = lines[-1]
-            if lastline.startswith("SyntaxError:"):
-                msglines = lines[-3:]
-            elif lastline.startswith("NameError:"):
-                msglines = lines[-1:]
-            else:
-                msglines = [str(e)]
-            errortext = "\n".join(msglines)
-            self.set_error(errortext)
+            self.__handle_exception(e)
+
+    def __handle_exception(self, e):
+        # type: (Exception) -> None
+        traceback.print_exc()
+        if isinstance(e, engine.SupertoolException):
+            self.set_error(str(e))
+            return
+        lines = traceback.format_exc().splitlines()
+        lastline = lines[-1]
+        if lastline.startswith("SyntaxError:"):
+            msglines = lines[-3:]
+        elif lastline.startswith("NameError:"):
+            msglines = lines[-1:]
+        else:
+            msglines = [str(e)]
+        errortext = "\n".join(msglines)
+        self.set_error(errortext)
 
     def __execute1(self):
         # type: () -> None
@@ -1018,8 +1857,6 @@ class SuperTool(ManagedWindow):
         if self.listview:
             self.output_window.remove(self.listview)
         self.listview = None
-        n = 0
-        LIMIT = 1000
 
         if self.category.objclass:
             if self.selected_objects.get_active():
@@ -1044,61 +1881,349 @@ class SuperTool(ManagedWindow):
         statements = get_text(self.statements).strip()
         filtertext = get_text(self.filter).strip()
         expressions = get_text(self.expressions).strip()
-        with self.progress(
-            "SuperTool", "Executing " + self.title.get_text(), len(selected_handles)
-        ) as step:
-            gramps_engine = GrampsEngine(
-                self.dbstate,
-                self.uistate,
-                self.category,
-                selected_handles,
-                initial_statements,
-                statements,
-                filtertext,
-                expressions,
-                unwind_lists,
-                commit_changes,
-                summary_only,
-                step,
+        processes = 0
+        if self.parallel_checkbox.get_active():
+            processes = os.cpu_count() or 1
+        result_cache = None
+        if self.cache_checkbox.get_active():
+            result_cache = self.result_cache
+        profiler = None
+        if self.profile_checkbox.get_active():
+            profiler = engine.Profiler()
+        commit_chunksize = 0
+        if self.batch_checkbox.get_active():
+            commit_chunksize = config.get("defaults.commit_chunksize")
+        args = dict(
+            selected_handles=selected_handles,
+            initial_statements=initial_statements,
+            statements=statements,
+            filter=filtertext,
+            expressions=expressions,
+            unwind_lists=unwind_lists,
+            commit_changes=commit_changes,
+            summary_only=summary_only,
+            all_objects=self.all_objects.get_active(),
+            processes=processes,
+            result_cache=result_cache,
+        )
+        self.gramps_engine = GrampsEngine(
+            self.dbstate,
+            self.uistate,
+            self.category,
+            step=self.__step,
+            report=self.__report,
+            profiler=profiler,
+            commit_chunksize=commit_chunksize,
+            txn_title=self.txtitle,
+            **args
+        )
+        if (
+            not commit_changes
+            and profiler is None
+            and self.category.objclass is not None
+            and can_run_in_background(self.db)
+            and not self.gramps_engine.use_parallel()
+        ):
+            # the rows of read-only queries are produced in a background
+            # thread; this engine is used only for the live updates. The
+            # worker processes of the parallel mode are forked only from the
+            # main thread, so a parallel query is run here
+            self.gramps_engine.compile_scripts()  # report syntax errors now
+            self.producer = RowProducer(
+                self.db.get_save_path(), self.category.category_name, args
             )
-            for values in gramps_engine.get_values(self.trans):
-                if not self.listview:
-                    # can build this only after the column types are known
-                    # (we assume the types are the same for all rows)
-                    self.build_listview(values)
-
-                self.store.append(None, values)
-                n += 1
-                if n >= LIMIT:
-                    OkDialog(
-                        _("Warning"),
-                        "Limit of {} rows reached".format(LIMIT),
-                        parent=self.uistate.window,
-                    )
-                    break
-        t2 = time.time()
+            self.producer.start()
+            self.rows_iter = None
+        else:
+            self.rows_iter = self.gramps_engine.get_values(self.trans)
+        self.live_handles = set(selected_handles)
+        self.pending_updates = set()
+        self.updated_handles = set()
+        self.skipped_handles = set()
+        self.object_count_delta = 0
+        self.result_rows = []
+        self.rows_pending = True
+        self.steps = 0
+        self.elapsed = time.time() - t1
+        if commit_changes:
+            # all objects must be processed inside the transaction
+            self.__fetch_all()
+        self.__show_page(0)
+
+    def __step(self):
+        # type: () -> bool
+        self.steps += 1
+        if self._progress:
+            return self._progress.step()
+        return False
 
-        msg = "Objects: {}/{}; rows: {} ({:.2f}s)".format(
-            gramps_engine.object_count, gramps_engine.total_objects, n, t2 - t1
+    def __report(self, message):
+        # type: (str) -> None
+        if self._progress:
+            self._progress.set_header(message)
+
+    def __run_engine(self):
+        # type: () -> GrampsEngine
+        # the engine that produces the rows
+        if self.producer and self.producer.engine:
+            return self.producer.engine
+        return self.gramps_engine
+
+    def __open_progress(self):
+        # type: () -> None
+        count = len(self.gramps_engine.selected_handles) - self.steps
+        self._progress = ProgressMeter("SuperTool", can_cancel=True)
+        self._progress.set_pass(
+            "Executing " + self.title.get_text(), count, ProgressMeter.MODE_FRACTION
         )
-        print(msg)
+
+    def __close_progress(self):
+        # type: () -> None
+        if self._progress:
+            self._progress.close()
+            self._progress = None
+
+    def __show_page(self, page):
+        # type: (int) -> None
+        self.page = page
+        start = page * PAGE_SIZE
+        if self.listview:
+            self.store.clear()
+        for values in self.result_rows[start : start + PAGE_SIZE]:
+            self.__append_row(values)
+        if (
+            self.rows_pending
+            and len(self.result_rows) < start + PAGE_SIZE
+            and self.fetch_id is None
+        ):
+            self.__start_fetching()
+        self.__update_status()
+
+    def __append_row(self, values):
+        # type: (List[Any]) -> None
+        if not self.listview:
+            # can build this only after the column types are known
+            # (we assume the types are the same for all rows)
+            self.build_listview(values)
+        self.store.append(None, values)
+
+    def __start_fetching(self):
+        # type: () -> None
+        self.__open_progress()
+        if self.producer:
+            self.fetch_id = GLib.timeout_add(FETCH_INTERVAL, self.__fetch_rows)
+        else:
+            self.fetch_id = GLib.idle_add(self.__fetch_rows)
+
+    def __stop_fetching(self):
+        # type: () -> None
+        if self.fetch_id is not None:
+            GLib.source_remove(self.fetch_id)
+            self.fetch_id = None
+        self.__close_progress()
+
+    def __cancel_run(self):
+        # type: () -> None
+        # stops the previous query for good, e.g. before a new one is started
+        self.__stop_fetching()
+        if self.producer:
+            self.producer.cancel()
+            self.producer = None
+        self.rows_pending = False
+
+    def __next_rows(self, count, timeout=None):
+        # type: (int, Optional[float]) -> Tuple[List[List[Any]], bool]
+        # returns at most count rows from the result stream and whether the
+        # stream has ended
+        if not self.producer:
+            with self.gramps_engine.profiling():
+                rows = list(itertools.islice(self.rows_iter, count))
+            return rows, len(rows) < count
+        producer = self.producer
+        finished = producer.finished
+        rows = producer.get_rows(count, timeout)
+        if producer.error:
+            raise producer.error
+        # the progress meter follows the background thread
+        while self.steps < producer.steps:
+            self.steps += 1
+            if self._progress and self._progress.step():
+                producer.cancel()
+                return rows, True
+        return rows, finished and len(rows) < count
+
+    def __skip_updated(self, rows):
+        # type: (List[List[Any]]) -> List[List[Any]]
+        # drops the rows of the objects that a live update has already
+        # evaluated again; the engine counted each of them once
+        if not self.updated_handles:
+            return rows
+        kept = []
+        for values in rows:
+            handle = values[-1]
+            if handle in self.updated_handles:
+                if handle not in self.skipped_handles:
+                    self.skipped_handles.add(handle)
+                    self.object_count_delta -= 1
+            else:
+                kept.append(values)
+        return kept
+
+    def __fetch_rows(self):
+        # type: () -> bool
+        # idle callback: moves the next batch of rows from the result stream
+        # to the current page; returns False when the page is full or
+        # there are no more rows
+        t1 = time.time()
+        end = (self.page + 1) * PAGE_SIZE
+        count = end - len(self.result_rows)
+        if not self.producer:
+            count = min(FETCH_BATCHSIZE, count)
+        try:
+            rows, at_end = self.__next_rows(count)
+            for values in self.__skip_updated(rows):
+                self.result_rows.append(values)
+                self.__append_row(values)
+        except Exception as e:
+            self.rows_pending = False
+            self.fetch_id = None
+            self.__stop_fetching()
+            self.__update_buttons()
+            self.__handle_exception(e)
+            return False
+        finally:
+            self.elapsed += time.time() - t1
+        if at_end:
+            self.rows_pending = False
+        if self.rows_pending and len(self.result_rows) < end:
+            self.__update_status()
+            return True
+        self.fetch_id = None
+        self.__stop_fetching()
+        self.__update_status()
+        return False
+
+    def __fetch_all(self):
+        # type: () -> None
+        # reads the rest of the result stream (for commits and CSV files)
+        self.__stop_fetching()
+        if not self.rows_pending:
+            return
+        t1 = time.time()
+        self.__open_progress()
+        try:
+            if self.producer:
+                self.producer.resume()
+                at_end = False
+                while not at_end:
+                    rows, at_end = self.__next_rows(PAGE_SIZE, timeout=0.1)
+                    self.result_rows.extend(self.__skip_updated(rows))
+            else:
+                with self.gramps_engine.profiling():
+                    rows = list(self.rows_iter)
+                self.result_rows.extend(self.__skip_updated(rows))
+        finally:
+            self.rows_pending = False
+            self.elapsed += time.time() - t1
+            self.__close_progress()
+
+    def __update_status(self):
+        # type: () -> None
+        numrows = len(self.result_rows)
+        run_engine = self.__run_engine()
+        msg = "Objects: {}/{}; rows: {}".format(
+            run_engine.object_count + self.object_count_delta,
+            run_engine.total_objects,
+            numrows,
+        )
+        if self.rows_pending:
+            msg += "+"
+        if self.page > 0 or self.rows_pending or numrows > PAGE_SIZE:
+            start = self.page * PAGE_SIZE
+            end = min(start + PAGE_SIZE, numrows)
+            msg += "; page {}: rows {}-{}".format(self.page + 1, start + 1, end)
+        msg += run_engine.get_commit_summary()
+        if run_engine.cancelled or (self.producer and self.producer.cancelled):
+            msg += "; cancelled"
+        elif self.producer and self.producer.paused():
+            msg += "; paused"
+        elapsed = self.elapsed
+        if self.producer:
+            elapsed = self.producer.get_elapsed()
+        msg += " ({:.2f}s)".format(elapsed)
+        msg += run_engine.get_cache_summary()
+        if self.fetch_id is None:
+            print(msg)
+            if self.gramps_engine.profiler:
+                self.__show_profile()
         self.statusmsg.set_text(msg)
-        if n > 0:
+        self.__update_buttons()
+        self.output_window.show()
+
+    def __update_buttons(self):
+        # type: () -> None
+        fetching = self.fetch_id is not None
+        if self.result_rows:
             self.btn_csv.show()
             self.btn_copy.show()
         else:
             self.btn_csv.hide()
             self.btn_copy.hide()
-        self.output_window.show()
+        end = (self.page + 1) * PAGE_SIZE
+        more = self.rows_pending or len(self.result_rows) > end
+        if self.page > 0 or more:
+            self.btn_prev_page.show()
+            self.btn_next_page.show()
+        else:
+            self.btn_prev_page.hide()
+            self.btn_next_page.hide()
+        self.btn_prev_page.set_sensitive(self.page > 0 and not fetching)
+        self.btn_next_page.set_sensitive(more and not fetching)
+        if fetching and self.producer:
+            if self.producer.paused():
+                self.btn_pause.set_label("Resume")
+            else:
+                self.btn_pause.set_label("Pause")
+            self.btn_pause.show()
+        else:
+            self.btn_pause.hide()
 
-    @contextmanager
-    def progress(self, title1, title2, count):
-        self._progress = ProgressMeter(title1, can_cancel=True)
-        self._progress.set_pass(title2, count, ProgressMeter.MODE_FRACTION)
-        try:
-            yield self._progress.step
-        finally:
-            self._progress.close()
+    def __show_profile(self):
+        # type: () -> None
+        text = self.gramps_engine.profiler.format_report()
+        if not self.profile_win:
+            self.profile_win = ProfileWindow()
+            font_description = self.btn_font.get_font_desc()
+            self.profile_win.modify_font(font_description)
+        self.profile_win.set_report(text)
+        self.profile_win.show_all()
+
+    def __hide_result_buttons(self):
+        # type: () -> None
+        self.btn_csv.hide()
+        self.btn_copy.hide()
+        self.btn_prev_page.hide()
+        self.btn_next_page.hide()
+        self.btn_pause.hide()
+
+    def pause_resume(self, obj):
+        # type: (Gtk.Widget) -> None
+        if not self.producer:
+            return
+        if self.producer.paused():
+            self.producer.resume()
+        else:
+            self.producer.pause()
+        self.__update_status()
+
+    def prev_page(self, obj):
+        # type: (Gtk.Widget) -> None
+        if self.page > 0:
+            self.__show_page(self.page - 1)
+
+    def next_page(self, obj):
+        # type: (Gtk.Widget) -> None
+        self.__show_page(self.page + 1)
 
     def build_listview(self, res):
         # type: (Tuple[Union[int,str,float],...]) -> None
@@ -1163,7 +2288,7 @@ class SuperTool(ManagedWindow):
         self, category, filtername, filtertext, initial_statements, statements
     ):
         the_filter = GenericFilterFactory(category.objclass)()
-        rule = category.filterrule([filtertext, initial_statements, statements])
+        rule = category.filterrule([filtertext, initial_statements, statements, "0"])
         if not filtername:
             OkDialog(
                 _("Error"), "Please supply a title/name", parent=self.uistate.window
@@ -1216,27 +2341,36 @@ class Tool(tool.Tool):
     def run_cli(self):
         script_filename = self.options.handler.options_dict["script"]
         if not script_filename:
-            print("No script_filename")
+            print("No script_filename", file=sys.stderr)
             return
         if not os.path.exists(script_filename):
-            print("Script file '{}' does not exist".format(script_filename))
+            print(
+                "Script file '{}' does not exist".format(script_filename),
+                file=sys.stderr,
+            )
             return
         output_filename = self.options.handler.options_dict.get("output")
-        print("script_filename:", script_filename)
+        print("script_filename:", script_filename, file=sys.stderr)
         scriptfile = ScriptFile()
-        print("scriptfile:", scriptfile)
+        print("scriptfile:", scriptfile, file=sys.stderr)
         query = scriptfile.load(script_filename)
-        print("query:", query)
-        print(self.options.handler.options_dict)
+        print("query:", query, file=sys.stderr)
+        print(self.options.handler.options_dict, file=sys.stderr)
         category_name = self.options.handler.options_dict.get("category")
-        print("category_name:", category_name)
+        print("category_name:", category_name, file=sys.stderr)
         if not category_name:
             category_name = query.category
         if not category_name:
-            print("No category name specified")
+            print("No category name specified", file=sys.stderr)
             return
         category = engine.get_category_info(self.db, category_name)
         selected_handles = category.get_all_objects_func()
+        result_cache = None
+        if query.cache_results:
+            result_cache = engine.ResultCache(self.db)
+        profile_filename = self.options.handler.options_dict.get("profile")
+        profiler = engine.Profiler() if profile_filename else None
+        commit_chunksize = self.options.handler.options_dict.get("commit_chunksize", 0)
         gramps_engine = GrampsEngine(
             self.dbstate,
             self.uistate,
@@ -1249,15 +2383,70 @@ class Tool(tool.Tool):
             query.unwind_lists,
             query.commit_changes,
             query.summary_only,
+            all_objects=True,
+            processes=self.options.handler.options_dict.get("processes", 0),
+            result_cache=result_cache,
+            report=lambda message: print(message, file=sys.stderr),
+            profiler=profiler,
+            commit_chunksize=commit_chunksize,
+            txn_title="Generating values",
         )
+        output_format = self.options.handler.options_dict.get("format")
+        if not output_format:
+            output_format = "csv" if output_filename else "jsonl"
+        if output_format not in ("csv", "jsonl"):
+            print("Unknown output format '{}'".format(output_format), file=sys.stderr)
+            return
+        t1 = time.time()
+        with gramps_engine.profiling():
+            if query.commit_changes and not commit_chunksize:
+                with DbTxn("Generating values", self.db) as trans:
+                    rows = gramps_engine.get_values(trans)
+                    self.write_rows(rows, output_filename, output_format)
+            else:  # read-only or GrampsEngine opens the batch transactions
+                rows = gramps_engine.get_values(None)
+                self.write_rows(rows, output_filename, output_format)
+        if profiler:
+            report = profiler.report()
+            report["objects"] = gramps_engine.total_objects
+            report["seconds"] = round(time.time() - t1, 6)
+            with open(profile_filename, "w") as f:
+                json.dump(report, f, indent=4)
+        print(
+            "Objects: {}/{}{}{}".format(
+                gramps_engine.object_count,
+                gramps_engine.total_objects,
+                gramps_engine.get_commit_summary(),
+                gramps_engine.get_cache_summary(),
+            ),
+            file=sys.stderr,
+        )
+
+    def write_rows(self, rows, output_filename, output_format):
+        # type: (Iterator[List[Any]], str, str) -> None
         if output_filename:
-            f = csv.writer(open(output_filename, "w"))
-        with DbTxn("Generating values", self.db) as trans:
-            for values in gramps_engine.get_values(trans):
-                if output_filename:
-                    f.writerow(values)
-                else:
-                    print(json.dumps(values))
+            f = open(
+                output_filename,
+                "w",
+                encoding="utf-8",
+                newline="",
+                buffering=WRITE_BUFFERSIZE,
+            )
+        else:
+            f = sys.stdout
+        try:
+            if output_format == "csv":
+                writer = csv.writer(f)
+                for chunk in chunked(rows, WRITE_CHUNKSIZE):
+                    writer.writerows(chunk)
+            else:  # JSON Lines
+                for chunk in chunked(rows, WRITE_CHUNKSIZE):
+                    f.write("".join(json.dumps(values) + "\n" for values in chunk))
+        finally:
+            if f is sys.stdout:
+                f.flush()
+            else:
+                f.close()
 
     def run(self):
         # type: () -> None
@@ -1283,6 +2472,10 @@ class Options(tool.ToolOptions):
             script="",
             output="",
             category="",
+            format="",
+            processes=0,
+            profile="",
+            commit_chunksize=0,
         )
         self.options_help = dict(
             script=(
@@ -1290,7 +2483,31 @@ class Options(tool.ToolOptions):
                 "Script file name",
                 "A {} file name".format(SCRIPTFILE_EXTENSION),
             ),
-            output=("=str", "Output CSV file name (optional)", "a CSV file name"),
+            output=("=str", "Output file name (optional)", "a CSV file name"),
+            format=(
+                "=str",
+                "Output format (optional); default is csv for a file, jsonl for "
+                "the standard output",
+                ["csv", "jsonl"],
+                False,
+            ),
+            processes=(
+                "=num",
+                "Number of worker processes for read-only queries (optional)",
+                "an integer; 0 = no parallel execution",
+            ),
+            profile=(
+                "=str",
+                "Write the time spent in each phase and proxy property to a "
+                "JSON file (optional)",
+                "a JSON file name",
+            ),
+            commit_chunksize=(
+                "=num",
+                "Commit the changes in batch transactions of this many objects "
+                "(optional)",
+                "an integer; 0 = one transaction for the whole run",
+            ),
             category=(
                 "=str",
                 "Object category (optional)",
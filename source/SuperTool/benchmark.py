@@ -0,0 +1,421 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2021      Kari Kujansuu
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Benchmark for the SuperTool engine.
+
+Generates synthetic family trees with people, families, events, places,
+sources and citations into temporary databases and runs a set of
+representative queries (and optionally script files) through GrampsEngine
+without the user interface. For each tree size and query the number of
+objects and rows, the throughput, the peak memory and the time spent in
+each phase are reported. Each query runs in a new process so that the
+peak memory is that of the query alone.
+
+Usage (in the SuperTool directory, Gramps must be importable):
+
+    python3 benchmark.py
+    python3 benchmark.py --sizes 1000,10000 --output results.json
+    python3 benchmark.py --sizes 100000 --keep /tmp/trees --script my.script
+
+The generated trees are deleted after the run unless --keep is given; a
+kept tree is reused by later runs with the same --keep directory. The
+results of different versions can be compared with the JSON output.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import gi
+
+gi.require_version("Gtk", "3.0")
+
+from gramps.gen.db.txn import DbTxn
+from gramps.gen.db.utils import make_database
+from gramps.gen.lib import (
+    ChildRef,
+    Citation,
+    Date,
+    Event,
+    EventRef,
+    EventType,
+    Family,
+    Name,
+    Person,
+    Place,
+    PlaceName,
+    PlaceType,
+    Source,
+    Surname,
+)
+from gramps.gen.utils.id import create_id
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import supertool_engine as engine
+from SuperTool import GrampsEngine, ScriptFile
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# category, name, initial statements, statements, filter, expressions
+QUERIES = [
+    ("People", "names", "", "", "", "name, gender"),
+    ("People", "birth and death", "", "", "", "name, birth.date, death.date"),
+    (
+        "People",
+        "birth places",
+        "",
+        "",
+        "birth.place.name == 'Place 1'",
+        "name, birth.place.longname",
+    ),
+    (
+        "People",
+        "children",
+        "",
+        "children = flatten(family.children for family in families)",
+        "len(children) > 2",
+        "name, len(children)",
+    ),
+    (
+        "People",
+        "grandparents",
+        "",
+        "",
+        "",
+        "uniq(flatten(family.father.parent_families for family in parent_families))",
+    ),
+    ("Families", "spouses", "", "", "", "father.name, mother.name, len(children)"),
+    ("Events", "participants", "", "", "", "type, date, participants"),
+    (
+        "Places",
+        "events per place",
+        "",
+        "",
+        "",
+        "name, len(list(db.find_backlink_handles(handle, ['Event'])))",
+    ),
+    ("Citations", "citators", "", "", "", "page, source.title, citators"),
+    ("Sources", "citations", "", "", "", "title, len(citations)"),
+]
+
+# number of places, sources and people per family in the generated trees
+PEOPLE_PER_PLACE = 100
+PEOPLE_PER_SOURCE = 1000
+CHILDREN_PER_FAMILY = 4
+
+
+def create_tree(dirpath, num_people, seed=0):
+    """
+    Create a new SQLite database in dirpath and fill it with a synthetic
+    tree of num_people people. Person j (j >= 2) is a child of family
+    j // CHILDREN_PER_FAMILY whose parents are the people 2*k and 2*k+1, so
+    the tree has several generations. Everyone has a birth event, every
+    second person a death event; most events have a place and half of the
+    births a citation.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(dirpath)
+    with open(os.path.join(dirpath, "database.txt"), "w") as f:
+        f.write("sqlite")
+    with open(os.path.join(dirpath, "name.txt"), "w") as f:
+        f.write("SuperTool benchmark {}".format(num_people))
+    db = make_database("sqlite")
+    db.load(dirpath)
+
+    num_families = num_people // 2
+    num_places = max(10, num_people // PEOPLE_PER_PLACE)
+    num_sources = max(5, num_people // PEOPLE_PER_SOURCE)
+    person_handles = [create_id() for _ in range(num_people)]
+    family_handles = [create_id() for _ in range(num_families)]
+
+    def parent_family(j):
+        k = j // CHILDREN_PER_FAMILY
+        if k < num_families and 2 * k + 1 < j:
+            return k
+        return None
+
+    with DbTxn("Generate places and sources", db, batch=True) as trans:
+        place_handles = []
+        for i in range(num_places):
+            place = Place()
+            place.set_name(PlaceName(value="Place {}".format(i)))
+            place.set_type(PlaceType.CITY)
+            db.add_place(place, trans)
+            place_handles.append(place.handle)
+        source_handles = []
+        for i in range(num_sources):
+            source = Source()
+            source.set_title("Source {}".format(i))
+            db.add_source(source, trans)
+            source_handles.append(source.handle)
+
+    with DbTxn("Generate people", db, batch=True) as trans:
+        for j in range(num_people):
+            person = Person()
+            person.set_handle(person_handles[j])
+            person.set_gender(Person.MALE if j % 2 == 0 else Person.FEMALE)
+            surname = Surname()
+            surname.set_surname(
+                "Surname {}".format(rnd.randrange(num_people // 10 + 1))
+            )
+            surname.set_primary(True)
+            name = Name()
+            name.set_first_name("Person {}".format(j))
+            name.add_surname(surname)
+            person.set_primary_name(name)
+
+            k = parent_family(j)
+            # the parents of person j are about j/2, i.e. one generation
+            # per bit
+            birth_year = 1500 + 25 * j.bit_length() - rnd.randrange(10)
+            for eventtype, year in [
+                (EventType.BIRTH, birth_year),
+                (EventType.DEATH, birth_year + rnd.randrange(20, 90)),
+            ]:
+                if eventtype == EventType.DEATH and j % 2 == 1:
+                    continue
+                event = Event()
+                event.set_type(eventtype)
+                date = Date()
+                date.set_yr_mon_day(
+                    year, rnd.randrange(1, 13), rnd.randrange(1, 29)
+                )
+                event.set_date_object(date)
+                if rnd.random() < 0.9:
+                    event.set_place_handle(rnd.choice(place_handles))
+                if eventtype == EventType.BIRTH and rnd.random() < 0.5:
+                    citation = Citation()
+                    citation.set_reference_handle(rnd.choice(source_handles))
+                    citation.set_page("Page {}".format(j))
+                    db.add_citation(citation, trans)
+                    event.add_citation(citation.handle)
+                db.add_event(event, trans)
+                eventref = EventRef()
+                eventref.set_reference_handle(event.handle)
+                person.add_event_ref(eventref)
+                if eventtype == EventType.BIRTH:
+                    person.set_birth_ref(eventref)
+                else:
+                    person.set_death_ref(eventref)
+
+            if j // 2 < num_families:
+                person.add_family_handle(family_handles[j // 2])
+            if k is not None:
+                person.add_parent_family_handle(family_handles[k])
+            db.add_person(person, trans)
+
+    with DbTxn("Generate families", db, batch=True) as trans:
+        for k in range(num_families):
+            family = Family()
+            family.set_handle(family_handles[k])
+            family.set_father_handle(person_handles[2 * k])
+            family.set_mother_handle(person_handles[2 * k + 1])
+            for j in range(CHILDREN_PER_FAMILY * k, CHILDREN_PER_FAMILY * (k + 1)):
+                if j < num_people and parent_family(j) == k:
+                    childref = ChildRef()
+                    childref.set_reference_handle(person_handles[j])
+                    family.add_child_ref(childref)
+            db.add_family(family, trans)
+    return db
+
+
+def open_tree(dirpath):
+    db = make_database("sqlite")
+    db.load(dirpath)
+    return db
+
+
+def run_query_in_tree(dirpath, query, use_tracemalloc=False):
+    "Open the tree and run one query; called in a new process for each query"
+    db = open_tree(dirpath)
+    try:
+        return run_query(db, query, use_tracemalloc)
+    finally:
+        db.close()
+
+
+def run_query(db, query, use_tracemalloc=False):
+    """
+    Run one query over all objects of its category and return the
+    measurements.
+    """
+    category_name, name, initial, statements, filter, expressions = query
+    dbstate = types.SimpleNamespace(db=db)
+    category = engine.get_category_info(db, category_name)
+    profiler = engine.Profiler()
+    if use_tracemalloc:
+        tracemalloc.start()
+    t1 = time.perf_counter()
+    gramps_engine = GrampsEngine(
+        dbstate,
+        None,
+        category,
+        category.get_all_objects_func(),
+        initial,
+        statements,
+        filter,
+        expressions,
+        False,
+        False,
+        False,
+        all_objects=True,
+        profiler=profiler,
+    )
+    num_rows = 0
+    with gramps_engine.profiling():
+        for _ in gramps_engine.get_values(None):
+            num_rows += 1
+    seconds = time.perf_counter() - t1
+    result = dict(
+        category=category_name,
+        query=name,
+        objects=gramps_engine.total_objects,
+        rows=num_rows,
+        seconds=round(seconds, 6),
+        objects_per_second=round(gramps_engine.total_objects / seconds, 1)
+        if seconds
+        else None,
+        peak_rss_mb=round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        phases=profiler.report()["phases"],
+    )
+    if use_tracemalloc:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_alloc_mb"] = round(peak / (1024 * 1024), 1)
+    return result
+
+
+def load_scripts(filenames):
+    queries = []
+    for filename in filenames:
+        query = ScriptFile().load(filename)
+        queries.append(
+            (
+                query.category,
+                os.path.basename(filename),
+                query.initial_statements,
+                query.statements,
+                query.filter,
+                query.expressions,
+            )
+        )
+    return queries
+
+
+def format_result(result):
+    line = "{category:10} {query:20} {objects:>9} objects {rows:>9} rows".format(
+        **result
+    )
+    line += " {:>9.2f}s".format(result["seconds"])
+    if result["objects_per_second"] is not None:
+        line += " {:>10.0f} obj/s".format(result["objects_per_second"])
+    line += " peak {:.0f} MB".format(result["peak_rss_mb"])
+    if "peak_alloc_mb" in result:
+        line += " (allocated {:.0f} MB)".format(result["peak_alloc_mb"])
+    phases = ", ".join(
+        "{} {:.2f}s".format(phase["name"], phase["seconds"])
+        for phase in result["phases"]
+    )
+    return line + "\n    " + phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SuperTool benchmark")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma separated numbers of people in the generated trees",
+    )
+    parser.add_argument(
+        "--keep",
+        metavar="DIR",
+        help="keep the generated trees in this directory and reuse them",
+    )
+    parser.add_argument(
+        "--script",
+        action="append",
+        default=[],
+        help="also run this SuperTool script file (can be repeated)",
+    )
+    parser.add_argument(
+        "--only-scripts",
+        action="store_true",
+        help="run only the script files, not the built-in queries",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="measure the peak Python memory allocation of each query (slow)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    queries = [] if args.only_scripts else list(QUERIES)
+    queries.extend(load_scripts(args.script))
+    # ru_maxrss is the peak of the whole process, so every query gets a
+    # fresh one
+    context = multiprocessing.get_context("spawn")
+    basedir = args.keep or tempfile.mkdtemp(prefix="supertool-benchmark-")
+    results = []
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            dirpath = os.path.join(basedir, "tree-{}-{}".format(size, args.seed))
+            t1 = time.perf_counter()
+            if os.path.exists(dirpath):
+                print("Tree of {} people found".format(size))
+            else:
+                create_tree(dirpath, size, args.seed).close()
+                print(
+                    "Tree of {} people generated in {:.1f}s".format(
+                        size, time.perf_counter() - t1
+                    )
+                )
+            for query in queries:
+                with context.Pool(1) as pool:
+                    result = pool.apply(
+                        run_query_in_tree, (dirpath, query, args.tracemalloc)
+                    )
+                result["people"] = size
+                results.append(result)
+                print(format_result(result))
+    finally:
+        if not args.keep:
+            shutil.rmtree(basedir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
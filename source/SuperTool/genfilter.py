@@ -90,29 +90,62 @@ class GenericFilterRule(Rule):
         (_("Rule:"), MyTextView),
         (_("Initial statements:"), MyTextView),
         (_("Statements:"), MyTextView),
+        (_("Evaluate all objects at once:"), MyBoolean),
     ]
     name = _("Generic filter rule")
 
     description = "Generic filter rule"
     category = _("Isotammi filters")
 
+    def __init__(self, arg, *args, **kwargs):
+        # rules saved before the last option was added have only three values
+        if arg is not None and len(arg) < len(self.labels):
+            arg = list(arg) + ["0"] * (len(self.labels) - len(arg))
+        Rule.__init__(self, arg, *args, **kwargs)
+
     def prepare(self, db, user):
         # things we want to do just once, not for every handle
 
-        self.db = db
+        # related objects are read through a cache that lives until reset()
+        self.db = engine.CachingDb(db)
         dbstate = self  # self emulates dbstate
         self.rule = self.list[0].replace("<br>", " ").strip()
         self.initial_statements = self.list[1].replace("<br>", "\n").strip()
         self.statements = self.list[2].replace("<br>", "\n").strip()
 
+        # compile once, the code objects are used for every object
+        self.rule_code = engine.compile_code(self.rule)
+        self.statements_code = None
+        self.rule_first = False
+        if self.statements:
+            self.statements_code = engine.compile_code(self.statements, "exec")
+            # if the statements cannot affect the result of the rule they
+            # are executed only for the objects that the rule accepts
+            self.rule_first = engine.can_filter_first(
+                self.statements, self.rule, self.initial_statements
+            )
+
         self.init_env = {}  # type: Dict[str,Any]
         self.init_env["trans"] = None
         s = self.initial_statements
         if s:
+            code = engine.compile_code(s, "exec")
             value, self.init_env = self.execute_func(
-                dbstate, None, s, self.init_env, "exec"
+                dbstate, None, code, self.init_env, "exec"
             )
 
+        # the variables that are the same for every object; apply() resets
+        # the namespace to these instead of building a new one
+        self.base_env = engine.make_env(dbstate, self.proxyclass)
+        self.base_env.update(self.init_env)
+        self.env = engine.LazyEnv()
+
+        # bulk mode: evaluate all objects in one pass over the table and
+        # remember the matching handles; apply() is then a set lookup
+        self.matches = None
+        if bool(int(self.list[3] or "0")):
+            self.matches = self.evaluate_all(db)
+
     #         if len(self.list) == 1:
     #             self.list = ["0", self.list[0]]
     #         self.rule = self.list[1]
@@ -120,17 +153,46 @@ class GenericFilterRule(Rule):
     #         if int(self.list[0]):
     #             OkDialog("Rule",self.rule)
 
+    def evaluate_all(self, db):
+        # type: (Any) -> Set[str]
+        paths = engine.find_attribute_paths(self.rule)
+        if self.statements:
+            paths |= engine.find_attribute_paths(self.statements, "exec")
+        for namespace in engine.get_prefetch_namespaces(paths, self.proxyclass):
+            self.db.prefetch(namespace)
+        iterator = getattr(db, engine.CachingDb.iterators[self.proxyclass.namespace])
+        return {obj.handle for obj in iterator() if self.evaluate(obj)}
+
+    def reset(self):
+        self.db = None
+        self.init_env = None
+        self.base_env = None
+        self.env = None
+        self.matches = None
+
     def apply(self, db, obj):
-        self.db = db
-        dbstate = self  # self emulates dbstate
+        if self.matches is not None:
+            return obj.handle in self.matches
+        return self.evaluate(obj)
+
+    def evaluate(self, obj):
         try:
-            env = {}
-            env.update(self.init_env)
-            s = self.statements
-            if s:
-                value, env = self.execute_func(dbstate, obj, s, env, "exec")
-            res, env = self.execute_func(dbstate, obj, self.rule, env)
-            return res
+            env = self.env
+            env.clear()
+            env.update(self.base_env)
+            env.proxy = self.proxyclass(self.db, obj.handle, obj)
+            env["self"] = env.proxy
+            env["env"] = env
+            if self.rule_first:
+                # the statements still run so that an error in them
+                # rejects the object
+                result = eval(self.rule_code, env, env)
+                if result:
+                    exec(self.statements_code, env, env)
+                return result
+            if self.statements_code:
+                exec(self.statements_code, env, env)
+            return eval(self.rule_code, env, env)
         except:
             traceback.print_exc()
             return False
@@ -140,54 +202,63 @@ class GenericFilterRule_Family(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_family
+        self.proxyclass = engine.FamilyProxy
 
 
 class GenericFilterRule_Person(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_person
+        self.proxyclass = engine.PersonProxy
 
 
 class GenericFilterRule_Place(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_place
+        self.proxyclass = engine.PlaceProxy
 
 
 class GenericFilterRule_Event(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_event
+        self.proxyclass = engine.EventProxy
 
 
 class GenericFilterRule_Source(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_source
+        self.proxyclass = engine.SourceProxy
 
 
 class GenericFilterRule_Citation(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_citation
+        self.proxyclass = engine.CitationProxy
 
 
 class GenericFilterRule_Repository(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_repository
+        self.proxyclass = engine.RepositoryProxy
 
 
 class GenericFilterRule_Note(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_note
+        self.proxyclass = engine.NoteProxy
 
 
 class GenericFilterRule_Media(GenericFilterRule):
     def __init__(self, *args):
         GenericFilterRule.__init__(self, *args)
         self.execute_func = engine.execute_media
+        self.proxyclass = engine.MediaProxy
 
 
 def importfile(fname):
@@ -23,11 +23,28 @@
 # Standard Python modules
 #
 # -------------------------------------------------------------------------
+import ast
 import collections
 import functools
+import hashlib
+import json
 import os
 import re
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    from typing import Any
+    from typing import Dict
+    from typing import FrozenSet
+    from typing import Iterator
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+except:
+    pass
 
 # -------------------------------------------------------------------------
 #
@@ -109,6 +126,19 @@ def gentolist(orig):
 
 @functools.total_ordering
 class Proxy:
+    # attribute name -> namespace of the related objects it returns;
+    # used to find out which objects a query will need (see get_prefetch_namespaces)
+    _references = {}  # type: Dict[str,str]
+
+    # attribute name -> other namespaces the attribute reads, e.g. through
+    # back references; the returned objects are in _references if they all
+    # have the same type
+    _reads = {}  # type: Dict[str,Tuple[str,...]]
+
+    # the proxies are created for every object and related object, so they
+    # have no __dict__; see get_attribute_names
+    __slots__ = ("db", "handle", "obj", "gramps_id")
+
     def __init__(self, db, handle):
         self.db = db
         self.handle = handle
@@ -116,6 +146,9 @@ class Proxy:
     def __eq__(self, other):
         return self.handle == other.handle
 
+    def __hash__(self):
+        return hash(self.handle)
+
     def __repr__(self):
         classname = self.__class__.__name__
         objname = classname.replace("Proxy", "")
@@ -132,6 +165,8 @@ class Proxy:
 
 
 class AttributeProxy:
+    __slots__ = ()
+
     @listproperty
     def attributes(self):
         for attr in self.obj.get_attribute_list():
@@ -140,6 +175,8 @@ class AttributeProxy:
 
 @functools.total_ordering
 class NullProxy:
+    __slots__ = ()
+
     def __getattr__(self, attrname):
         return NullProxy()
 
@@ -173,6 +210,8 @@ nullproxy = NullProxy()
 
 @functools.total_ordering
 class DateProxy:
+    __slots__ = ("dateobj", "obj")
+
     def __init__(self, dateobj):
         self.dateobj = dateobj
         self.obj = dateobj
@@ -206,6 +245,9 @@ class DateProxy:
 
 
 class CommonProxy(Proxy):
+    _references = {"citations": "Citation", "notes": "Note"}
+    __slots__ = ()
+
     def __init__(self, db, handle):
         Proxy.__init__(self, db, handle)
 
@@ -222,6 +264,7 @@ class CommonProxy(Proxy):
 
 class NoteProxy(Proxy):
     namespace = "Note"
+    __slots__ = ("note", "text")
 
     def __init__(self, db, handle, note=None):
         Proxy.__init__(self, db, handle)
@@ -236,6 +279,13 @@ class NoteProxy(Proxy):
 
 class CitationProxy(Proxy, AttributeProxy):
     namespace = "Citation"
+    __slots__ = ("citation", "confidence", "page")
+    _references = {
+        "source": "Source",
+        "notes": "Note",
+        "note": "Note",
+    }
+    _reads = {"citators": ("Event", "Person")}
 
     def __init__(self, db, handle, citation=None):
         Proxy.__init__(self, db, handle)
@@ -282,6 +332,12 @@ class CitationProxy(Proxy, AttributeProxy):
 
 class SourceProxy(Proxy, AttributeProxy):
     namespace = "Source"
+    __slots__ = ("source", "title", "author", "abbrev", "pubinfo")
+    _references = {
+        "repositories": "Repository",
+        "citations": "Citation",
+        "notes": "Note",
+    }
 
     def __init__(self, db, handle, source=None):
         Proxy.__init__(self, db, handle)
@@ -316,6 +372,8 @@ class SourceProxy(Proxy, AttributeProxy):
 
 class RepositoryProxy(Proxy):
     namespace = "Repository"
+    __slots__ = ("repository", "name", "type")
+    _references = {"sources": "Source"}
 
     def __init__(self, db, handle, repository=None):
         Proxy.__init__(self, db, handle)
@@ -338,6 +396,13 @@ class RepositoryProxy(Proxy):
 
 class PlaceProxy(CommonProxy):
     namespace = "Place"
+    __slots__ = ("place", "code", "lat", "long")
+    _references = dict(
+        CommonProxy._references,
+        longname="Place",
+        enclosed_by="Place",
+        encloses="Place",
+    )
 
     def __init__(self, db, place_handle, place=None):
         CommonProxy.__init__(self, db, place_handle)
@@ -387,6 +452,14 @@ class PlaceProxy(CommonProxy):
 
 class EventProxy(CommonProxy, AttributeProxy):
     namespace = "Event"
+    __slots__ = ("event", "type", "date", "description", "role")
+    _references = dict(
+        CommonProxy._references,
+        place="Place",
+        placename="Place",
+        participants="Person",
+    )
+    _reads = {"participants": ("Person", "Family"), "refs": ("Person", "Family")}
 
     def __init__(self, db, event_handle, event=None, role=None):
         CommonProxy.__init__(self, db, event_handle)
@@ -456,6 +529,15 @@ class EventProxy(CommonProxy, AttributeProxy):
 
 class PersonProxy(CommonProxy, AttributeProxy):
     namespace = "Person"
+    __slots__ = ("person",)
+    _references = dict(
+        CommonProxy._references,
+        birth="Event",
+        death="Event",
+        events="Event",
+        families="Family",
+        parent_families="Family",
+    )
 
     def __init__(self, db, person_handle, person=None):
         CommonProxy.__init__(self, db, person_handle)
@@ -523,6 +605,14 @@ class PersonProxy(CommonProxy, AttributeProxy):
 
 class FamilyProxy(CommonProxy, AttributeProxy):
     namespace = "Family"
+    __slots__ = ("family",)
+    _references = dict(
+        CommonProxy._references,
+        events="Event",
+        father="Person",
+        mother="Person",
+        children="Person",
+    )
 
     def __init__(self, db, family_handle, family=None):
         CommonProxy.__init__(self, db, family_handle)
@@ -560,6 +650,7 @@ class FamilyProxy(CommonProxy, AttributeProxy):
 
 class MediaProxy(CommonProxy, AttributeProxy):
     namespace = "Media"
+    __slots__ = ("media", "path", "mime", "desc", "checksum", "date")
 
     def __init__(self, db, media_handle, media=None):
         CommonProxy.__init__(self, db, media_handle)
@@ -576,6 +667,43 @@ class MediaProxy(CommonProxy, AttributeProxy):
         self.date = DateProxy(self.media.date)
 
 
+PROXYCLASSES = {
+    proxyclass.namespace: proxyclass
+    for proxyclass in [
+        PersonProxy,
+        FamilyProxy,
+        EventProxy,
+        PlaceProxy,
+        CitationProxy,
+        SourceProxy,
+        RepositoryProxy,
+        NoteProxy,
+        MediaProxy,
+    ]
+}
+
+# proxy class -> names of its properties, methods and slots
+attribute_names = {}  # type: Dict[type,FrozenSet[str]]
+
+
+def get_attribute_names(proxyclass):
+    # type: (type) -> FrozenSet[str]
+    names = attribute_names.get(proxyclass)
+    if names is None:
+        names = frozenset(
+            name for name in dir(proxyclass) if not name.startswith("_")
+        )
+        attribute_names[proxyclass] = names
+    return names
+
+
+ALL_REFERENCES = {}  # type: Dict[str,str]
+ALL_READS = {}  # type: Dict[str,Tuple[str,...]]
+for proxyclass in PROXYCLASSES.values():
+    ALL_REFERENCES.update(proxyclass._references)
+    ALL_READS.update(proxyclass._reads)
+
+
 def uniq(items):
     return list(set(items))
 
@@ -642,6 +770,487 @@ class DummyTxn:
         self.txn = _Txn
 
 
+# maximum number of objects in the CachingDb cache (in addition to the
+# prefetched tables)
+CACHE_SIZE = 20000
+
+# backlinks from objects of a type are looked up in the database this many
+# times; after that all objects of the type are read once and the backlinks
+# are served from an index
+BACKLINK_INDEX_THRESHOLD = 20
+
+
+class CachingDb:
+    """
+    Database wrapper used during one SuperTool run. The proxy objects fetch
+    the related objects through the get_*_from_handle methods of this object
+    so the tables read in with prefetch() and the most recently used objects
+    are served from memory instead of separate database reads. Everything
+    else is delegated to the real database object.
+
+    Objects committed or removed through this object are dropped from the
+    cache; other code should call invalidate(). The cached objects are shared
+    by all readers, so an unsaved change to one is seen by the others; with
+    maxsize 0 every read returns a new object.
+
+    find_backlink_handles() is answered from an index of the references
+    when it is called often enough for the same referring object type. The
+    index of a type is not used any more after objects of that type have
+    been modified.
+    """
+
+    iterators = {
+        "Person": "iter_people",
+        "Family": "iter_families",
+        "Event": "iter_events",
+        "Place": "iter_places",
+        "Citation": "iter_citations",
+        "Source": "iter_sources",
+        "Repository": "iter_repositories",
+        "Note": "iter_notes",
+        "Media": "iter_media",
+    }
+
+    # methods that modify an object: name -> namespace
+    modifiers = {}  # type: Dict[str,str]
+    for namespace, name in [
+        ("Person", "person"),
+        ("Family", "family"),
+        ("Event", "event"),
+        ("Place", "place"),
+        ("Citation", "citation"),
+        ("Source", "source"),
+        ("Repository", "repository"),
+        ("Note", "note"),
+        ("Media", "media"),
+    ]:
+        modifiers["commit_" + name] = namespace
+        modifiers["remove_" + name] = namespace
+    del namespace, name
+
+    def __init__(self, db, maxsize=CACHE_SIZE):
+        self.db = db
+        self.tables = {}  # type: Dict[str,Dict[str,Any]]
+        self.cache = collections.OrderedDict()  # (namespace,handle) -> object
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # referrer namespace -> referenced handle -> [(namespace, handle)];
+        # None if the index cannot be used
+        self.backlinks = {}  # type: Dict[str,Optional[Dict[str,List[Tuple[str,str]]]]]
+        self.backlink_lookups = collections.Counter()  # type: Dict[str,int]
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        namespace = self.modifiers.get(name)
+        if namespace is None:
+            return attr
+
+        def modify(obj, *args, **kwargs):
+            # commit_xxx(obj, trans) or remove_xxx(handle, trans)
+            res = attr(obj, *args, **kwargs)
+            self.invalidate(namespace, getattr(obj, "handle", obj))
+            return res
+
+        return modify
+
+    def invalidate(self, namespace, handle):
+        "Drop an object that was modified or deleted"
+        self.cache.pop((namespace, handle), None)
+        table = self.tables.get(namespace)
+        if table is not None:
+            table.pop(handle, None)
+        self.backlinks[namespace] = None
+
+    def hit_rate(self):
+        "Fraction of the lookups served from memory, None if no lookups"
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return None
+        return self.hits / lookups
+
+    def prefetch(self, namespace):
+        "Read all objects of the namespace with a single pass over the table"
+        iterfunc = getattr(self.db, self.iterators[namespace])
+        self.tables[namespace] = {obj.handle: obj for obj in iterfunc()}
+
+    def build_backlink_index(self, namespace):
+        "Collect the references from all objects of the namespace"
+        index = collections.defaultdict(list)
+        table = self.tables.get(namespace)
+        if table is not None:
+            objects = table.values()
+        else:
+            objects = getattr(self.db, self.iterators[namespace])()
+        for obj in objects:
+            referenced = set()
+            for _, handle in obj.get_referenced_handles_recursively():
+                if handle not in referenced:
+                    referenced.add(handle)
+                    index[handle].append((namespace, obj.handle))
+        self.backlinks[namespace] = index
+
+    def find_backlink_handles(self, handle, include_classes=None):
+        if not include_classes:
+            return self.db.find_backlink_handles(handle, include_classes)
+        refs = []
+        for namespace in include_classes:
+            if namespace not in self.backlinks:
+                self.backlink_lookups[namespace] += 1
+                if self.backlink_lookups[namespace] > BACKLINK_INDEX_THRESHOLD:
+                    self.build_backlink_index(namespace)
+            index = self.backlinks.get(namespace)
+            if index is None:
+                refs.extend(self.db.find_backlink_handles(handle, [namespace]))
+            else:
+                refs.extend(index.get(handle, []))
+        return refs
+
+    def get_object(self, namespace, handle, getfunc):
+        table = self.tables.get(namespace)
+        if table is not None:
+            obj = table.get(handle)
+            if obj is not None:
+                self.hits += 1
+                return obj
+        key = (namespace, handle)
+        obj = self.cache.get(key)
+        if obj is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return obj
+        self.misses += 1
+        obj = getfunc(handle)
+        if obj is not None and self.maxsize > 0:
+            self.cache[key] = obj
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return obj
+
+    def get_person_from_handle(self, handle):
+        return self.get_object("Person", handle, self.db.get_person_from_handle)
+
+    def get_family_from_handle(self, handle):
+        return self.get_object("Family", handle, self.db.get_family_from_handle)
+
+    def get_event_from_handle(self, handle):
+        return self.get_object("Event", handle, self.db.get_event_from_handle)
+
+    def get_place_from_handle(self, handle):
+        return self.get_object("Place", handle, self.db.get_place_from_handle)
+
+    def get_citation_from_handle(self, handle):
+        return self.get_object("Citation", handle, self.db.get_citation_from_handle)
+
+    def get_source_from_handle(self, handle):
+        return self.get_object("Source", handle, self.db.get_source_from_handle)
+
+    def get_repository_from_handle(self, handle):
+        return self.get_object(
+            "Repository", handle, self.db.get_repository_from_handle
+        )
+
+    def get_note_from_handle(self, handle):
+        return self.get_object("Note", handle, self.db.get_note_from_handle)
+
+    def get_media_from_handle(self, handle):
+        return self.get_object("Media", handle, self.db.get_media_from_handle)
+
+
+class RunState:
+    "Emulates dbstate during a SuperTool run; 'db' is a CachingDb"
+
+    def __init__(self, dbstate, db):
+        self.dbstate = dbstate
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.dbstate, name)
+
+
+# at most this many query results are kept in the result cache
+MAX_CACHED_RESULTS = 50
+
+
+def get_db_marker(db):
+    """
+    Return a value that changes whenever something is written to the
+    database: the newest modification time of the files in the database
+    directory. Returns None if the database is not stored in a directory.
+    """
+    dirpath = db.get_save_path()
+    if not dirpath or not os.path.isdir(dirpath):
+        return None
+    marker = 0
+    for name in os.listdir(dirpath):
+        if name == "lock":  # created every time the database is opened
+            continue
+        marker = max(marker, os.stat(os.path.join(dirpath, name)).st_mtime_ns)
+    return marker
+
+
+class ResultCache:
+    """
+    Results of read-only queries stored on disk, one file per query. The
+    index file records for each result the database marker (see
+    get_db_marker) at the time the result was computed and the object types
+    (namespaces) the query depends on. A result is used only if the marker
+    has not changed since.
+
+    When the database is changed in this Gramps session, changed() should be
+    called with the namespace of the changed objects: the results that depend
+    on that type are dropped and the others are marked valid for the new
+    database state.
+    """
+
+    # the index is updated both by the background thread that stores a result
+    # and by the signal handlers in the main thread
+    index_lock = threading.Lock()
+
+    def __init__(self, db, dirname=None):
+        from gramps.gen.const import USER_HOME
+
+        self.db = db
+        if dirname is None:
+            dirname = os.path.join(USER_HOME, "supertool", "cache")
+        self.dirname = dirname
+        self.indexfile = os.path.join(dirname, "index.json")
+        self.marker = get_db_marker(db)  # last marker seen in this session
+
+    def get_key(self, *parts):
+        # type: (Any) -> str
+        data = json.dumps([self.db.get_dbid()] + list(parts))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_marker(self):
+        marker = get_db_marker(self.db)
+        self.marker = marker
+        return marker
+
+    def __load_index(self):
+        # type: () -> Dict[str,Any]
+        try:
+            with open(self.indexfile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_index(self, index):
+        # type: (Dict[str,Any]) -> None
+        os.makedirs(self.dirname, exist_ok=True)
+        # a separate temporary file for each writer, e.g. another Gramps
+        # process using the same cache
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname, suffix=".tmp")
+        with open(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmpname, self.indexfile)
+
+    def __datafile(self, key):
+        # type: (str) -> str
+        return os.path.join(self.dirname, key + ".jsonl")
+
+    def __remove(self, index, key):
+        # type: (Dict[str,Any], str) -> None
+        del index[key]
+        try:
+            os.remove(self.__datafile(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        # type: (str) -> Optional[Tuple[Dict[str,Any],Iterator[List[Any]]]]
+        """
+        Return the header and an iterator over the rows of a valid cached
+        result, or None.
+        """
+        with self.index_lock:
+            index = self.__load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            marker = self.get_marker()
+            if marker is None or entry["marker"] != marker:
+                self.__remove(index, key)
+                self.__save_index(index)
+                return None
+        try:
+            f = open(self.__datafile(key), encoding="utf-8")
+        except OSError:
+            return None
+        return entry["header"], self.__read_rows(f)
+
+    def __read_rows(self, f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def put(self, key, marker, namespaces, header, rows):
+        # type: (str, Any, Optional[List[str]], Dict[str,Any], Iterator[List[Any]]) -> Iterator[List[Any]]
+        """
+        Pass the rows through and store them as the result for 'key'. The
+        result is stored only if all rows are consumed and the database has
+        not changed since 'marker' was taken. 'namespaces' is None if the
+        query may depend on any object type. 'header' is a dict that the
+        caller may update until the last row has been consumed.
+        """
+        if marker is None:
+            yield from rows
+            return
+        os.makedirs(self.dirname, exist_ok=True)
+        tmpname = self.__datafile(key) + ".tmp"
+        complete = False
+        try:
+            with open(tmpname, "w", encoding="utf-8") as f:
+                for values in rows:
+                    f.write(json.dumps(values) + "\n")
+                    yield values
+            complete = get_db_marker(self.db) == marker
+        finally:
+            if complete:
+                with self.index_lock:
+                    os.replace(tmpname, self.__datafile(key))
+                    index = self.__load_index()
+                    index.pop(key, None)
+                    index[key] = dict(
+                        marker=marker, namespaces=namespaces, header=header
+                    )
+                    # the oldest results are dropped first
+                    for oldkey in list(index)[: -MAX_CACHED_RESULTS]:
+                        self.__remove(index, oldkey)
+                    self.__save_index(index)
+            elif os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def changed(self, namespace):
+        # type: (str) -> None
+        """
+        Objects of type 'namespace' were changed in this session.
+        """
+        with self.index_lock:
+            index = self.__load_index()
+            if not index:
+                return
+            oldmarker = self.marker
+            marker = self.get_marker()
+            for key, entry in list(index.items()):
+                namespaces = entry["namespaces"]
+                if namespaces is None or namespace in namespaces:
+                    self.__remove(index, key)
+                elif oldmarker is not None and entry["marker"] == oldmarker:
+                    entry["marker"] = marker
+            self.__save_index(index)
+
+
+class Profiler:
+    """
+    Collects the time spent in the phases of a SuperTool run (e.g. fetching
+    the objects or executing the statements) and in the properties of the
+    proxy classes. The property times include the time spent in the other
+    properties that a property uses.
+
+    The property wrappers are installed in the proxy classes only between
+    install() and uninstall().
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()  # name -> [count, seconds]
+        self.properties = {}  # type: Dict[str,List[Any]]
+        self.saved = []  # type: List[Tuple[type,str,property]]
+
+    def add(self, name, seconds, stats=None):
+        # type: (str, float, Optional[Dict[str,List[Any]]]) -> None
+        if stats is None:
+            stats = self.phases
+        entry = stats.get(name)
+        if entry is None:
+            stats[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def lap(self, name, t1):
+        # type: (str, float) -> float
+        """
+        Add the time since t1 to the phase and return the current time.
+        """
+        t2 = time.perf_counter()
+        self.add(name, t2 - t1)
+        return t2
+
+    def timed(self, name, iterator):
+        # type: (str, Iterator[Any]) -> Iterator[Any]
+        """
+        Pass the items through and add the time taken by each item to the phase.
+        """
+        t1 = time.perf_counter()
+        for item in iterator:
+            self.lap(name, t1)
+            yield item
+            t1 = time.perf_counter()
+
+    def install(self):
+        # type: () -> None
+        classes = set()
+        for proxyclass in list(PROXYCLASSES.values()) + [DateProxy]:
+            classes.update(proxyclass.__mro__[:-1])  # not object
+        for cls in classes:
+            for name, attr in list(cls.__dict__.items()):
+                if isinstance(attr, property):
+                    self.saved.append((cls, name, attr))
+                    setattr(cls, name, self.__wrap(name, attr))
+
+    def uninstall(self):
+        # type: () -> None
+        for cls, name, attr in self.saved:
+            setattr(cls, name, attr)
+        self.saved = []
+
+    def __wrap(self, name, prop):
+        # type: (str, property) -> property
+        fget = prop.fget
+        properties = self.properties
+
+        def timed_fget(obj):
+            t1 = time.perf_counter()
+            try:
+                return fget(obj)
+            finally:
+                key = type(obj).__name__ + "." + name
+                self.add(key, time.perf_counter() - t1, properties)
+
+        return property(timed_fget, prop.fset, prop.fdel, prop.__doc__)
+
+    def report(self):
+        # type: () -> Dict[str,Any]
+        def rows(stats):
+            return [
+                dict(name=name, count=count, seconds=round(seconds, 6))
+                for name, (count, seconds) in sorted(
+                    stats.items(), key=lambda item: -item[1][1]
+                )
+            ]
+
+        return dict(phases=rows(self.phases), properties=rows(self.properties))
+
+    def format_report(self):
+        # type: () -> str
+        report = self.report()
+        lines = []
+        for title, key in [("Phase", "phases"), ("Property", "properties")]:
+            entries = report[key]
+            width = max([len(title)] + [len(entry["name"]) for entry in entries])
+            header = "{:{}}  {:>10}  {:>10}"
+            lines.append(header.format(title, width, "Calls", "Time (s)"))
+            for entry in entries:
+                lines.append(
+                    "{:{}}  {:>10}  {:>10.3f}".format(
+                        entry["name"], width, entry["count"], entry["seconds"]
+                    )
+                )
+            lines.append("")
+        return "\n".join(lines)
+
+
 def find_fullname(fname):
     TOOL_DIR = "supertool"
     from gramps.gen.const import USER_HOME
@@ -683,7 +1292,242 @@ def process_includes(code):
     return "".join(newlines)
 
 
-def execute(dbstate, obj, code, proxyclass, envvars=None, exectype=None):
+# compiled code objects; key = (expanded source, mode)
+compiled_code = {}  # type: Dict[Tuple[str,str],Any]
+MAX_COMPILED_CODE = 100
+
+
+def compile_code(code, exectype=None):
+    """
+    Compile user supplied statements (exectype == "exec") or an expression
+    (exectype == None). The result is cached so that the same script is
+    compiled only once even if it is executed for a large number of objects.
+
+    Include files are re-read on every call so the callers should compile
+    their scripts once per run and pass the code objects to execute().
+    """
+    if not isinstance(code, str):
+        return code  # already compiled
+    if exectype == "exec":
+        source = process_includes(code)
+        mode = "exec"
+    else:
+        source = code.replace("\n", " ")
+        mode = "eval"
+    key = (source, mode)
+    compiled = compiled_code.get(key)
+    if compiled is None:
+        if len(compiled_code) >= MAX_COMPILED_CODE:
+            compiled_code.clear()
+        compiled = compile(source, "<string>", mode)
+        compiled_code[key] = compiled
+    return compiled
+
+
+class LazyEnv(dict):
+    """
+    Namespace for the user code. The attributes of the proxy object
+    (e.g. 'birth', 'families' or 'citations') are evaluated only when the
+    code actually refers to them. The value is then stored in the namespace
+    so it is evaluated at most once for each object.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.proxy = None
+
+    def __missing__(self, name):
+        proxy = self.proxy
+        if proxy is None or name.startswith("_"):
+            raise KeyError(name)
+        if name not in get_attribute_names(type(proxy)):
+            raise KeyError(name)
+        value = getattr(proxy, name)
+        self[name] = value
+        return value
+
+
+def find_attribute_paths(code, exectype=None):
+    """
+    Find the names and attribute chains the user code refers to. For example
+    the expression 'birth.place.name' yields the path
+    ("birth", "place", "name"). If the chain does not start with a plain name
+    (e.g. 'families[0].children') then the first element is None.
+    """
+    if exectype == "exec":
+        tree = ast.parse(process_includes(code), mode="exec")
+    else:
+        tree = ast.parse(code.replace("\n", " "), mode="eval")
+    paths = set()
+    inner = set()  # nodes that are part of a longer chain
+    for node in ast.walk(tree):
+        if id(node) in inner:
+            continue
+        if not isinstance(node, (ast.Attribute, ast.Name)):
+            continue
+        names = []
+        while isinstance(node, ast.Attribute):
+            names.append(node.attr)
+            node = node.value
+            inner.add(id(node))
+        if isinstance(node, ast.Name):
+            names.append(node.id)
+        else:
+            names.append(None)
+        paths.add(tuple(reversed(names)))
+    return paths
+
+
+# method calls that probably modify the object they are called on
+MUTATING_METHODS = {
+    "add",
+    "append",
+    "clear",
+    "discard",
+    "extend",
+    "insert",
+    "pop",
+    "popitem",
+    "remove",
+    "reverse",
+    "setdefault",
+    "sort",
+    "update",
+}
+# statements that can have effects beyond assigning variables; an augmented
+# assignment (total += [name]) can modify a list in place
+SIDE_EFFECT_STATEMENTS = (
+    ast.Assert,
+    ast.AugAssign,
+    ast.Delete,
+    ast.Expr,
+    ast.Global,
+    ast.Nonlocal,
+    ast.Raise,
+)
+# functions with side effects
+SIDE_EFFECT_FUNCTIONS = {
+    "DummyTxn",
+    "delattr",
+    "eval",
+    "exec",
+    "globals",
+    "locals",
+    "open",
+    "print",
+    "setattr",
+    "vars",
+}
+
+
+def can_filter_first(statements, filter, initial_statements=""):
+    """
+    Return True if the filter can be evaluated before the statements, i.e.
+    the filter does not use any variable that the statements assign and
+    executing the statements has no other effects (e.g. modifying objects or
+    variables shared between objects) that could be seen by the filter or by
+    the other objects.
+
+    The analysis is conservative: any statement that is not obviously free of
+    side effects prevents the reordering. This includes calling a function
+    that the initial statements define or import and any call that gets a
+    variable of the initial statements as an argument or calls its method
+    (e.g. next(it) or it.send(x)), since the value is shared between the
+    objects.
+    """
+    defined = set()
+    if initial_statements:
+        for node in ast.walk(ast.parse(process_includes(initial_statements), mode="exec")):
+            if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+                defined.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                defined.add(node.name)
+            elif isinstance(node, ast.alias):
+                defined.add((node.asname or node.name).split(".")[0])
+    tree = ast.parse(process_includes(statements), mode="exec")
+    assigned = set()
+    for node in ast.walk(tree):
+        if isinstance(node, SIDE_EFFECT_STATEMENTS):
+            return False  # e.g. a bare function call: obj.set_gender(...)
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            if not isinstance(node.ctx, ast.Load):
+                return False  # e.g. x.attr = ... or counts[key] += 1
+        elif isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                assigned.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            assigned.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            assigned.add(node.name)
+        elif isinstance(node, ast.alias):
+            assigned.add((node.asname or node.name).split(".")[0])
+        elif isinstance(node, ast.Call):
+            func = node.func
+            # the variables of the initial statements are shared between
+            # the objects: it.send(x), next(it), f(*args)
+            receiver = func
+            while isinstance(receiver, (ast.Attribute, ast.Subscript)):
+                receiver = receiver.value
+            args = [receiver] if receiver is not func else []
+            args += node.args + [keyword.value for keyword in node.keywords]
+            for arg in args:
+                if isinstance(arg, ast.Starred):
+                    arg = arg.value
+                if isinstance(arg, ast.Name) and arg.id in defined:
+                    return False
+            if isinstance(func, ast.Attribute):
+                name = func.attr
+                if name in MUTATING_METHODS or name.startswith(
+                    ("set_", "add_", "remove_", "commit")
+                ):
+                    return False
+            elif isinstance(func, ast.Name) and (
+                func.id in SIDE_EFFECT_FUNCTIONS or func.id in defined
+            ):
+                return False
+    used = set()
+    for node in ast.walk(ast.parse(filter.replace("\n", " "), mode="eval")):
+        if isinstance(node, ast.Name):
+            used.add(node.id)
+    return "env" not in used and not (used & assigned)
+
+
+def get_prefetch_namespaces(paths, proxyclass):
+    """
+    Return the namespaces (e.g. "Event", "Place") of the related objects that
+    the attribute paths will fetch when evaluated for objects of 'proxyclass',
+    including the objects read to compute them (see Proxy._reads).
+
+    A name that is not a known proxy attribute (e.g. a loop variable) has an
+    unknown type; the following name is then looked up in the attributes of
+    all proxy classes.
+    """
+    namespaces = set()
+    for path in paths:
+        if path[0] == "self":
+            path = path[1:]
+        cls = proxyclass
+        for name in path:
+            if cls is not None:
+                namespace = cls._references.get(name)
+                namespaces.update(cls._reads.get(name, ()))
+            else:
+                namespace = ALL_REFERENCES.get(name)
+                namespaces.update(ALL_READS.get(name, ()))
+            if namespace:
+                namespaces.add(namespace)
+                cls = PROXYCLASSES[namespace]
+            else:
+                cls = None
+    return namespaces
+
+
+def make_env(dbstate, proxyclass):
+    """
+    Return the variables that are the same for every object: the helper
+    functions, modules and classes and the filter function for the object
+    type.
+    """
     env = dict(
         uniq=uniq,
         makedate=makedate,
@@ -714,28 +1558,32 @@ def execute(dbstate, obj, code, proxyclass, envvars=None, exectype=None):
         Media=Media,
         DummyTxn=DummyTxn,
     )
-    if obj:
-        p = proxyclass(dbstate.db, obj.handle, obj)
-        env["self"] = p
-        for name in dir(proxyclass) + list(
-            p.__dict__.keys()
-        ):  # this contains the @property methods
-            if name.startswith("_"):
-                continue
-            # print(">>",name)
-            value = getattr(p, name)
-            env[name] = value
-    filterfactory = Filterfactory(dbstate.db)
     if proxyclass:
+        filterfactory = Filterfactory(dbstate.db)
         env["filter"] = filterfactory.getfilter(proxyclass.namespace)
+    return env
+
+
+def execute(dbstate, obj, code, proxyclass, envvars=None, exectype=None):
+    env = LazyEnv(make_env(dbstate, proxyclass))
+    if obj:
+        if (
+            isinstance(envvars, LazyEnv)
+            and envvars.proxy is not None
+            and envvars.proxy.handle == obj.handle
+        ):
+            p = envvars.proxy  # same object as in the previous phase
+        else:
+            p = proxyclass(dbstate.db, obj.handle, obj)
+        env["self"] = p
+        env.proxy = p  # the proxy attributes are looked up on demand
     if envvars:
         env.update(envvars)
     env["env"] = env
+    code = compile_code(code, exectype)
     if exectype == "exec":
-        code = process_includes(code)
         res = exec(code, env, env)
     else:
-        code = code.replace("\n", " ")
         res = eval(code, env, env)
     return res, env
 
@@ -804,10 +1652,13 @@ def get_category_info(db, category_name):
 
     info = Category()
 
+    info.category_name = category_name
     info.objclass = None
     info.execute_func = execute_no_category
     if category_name == "People":
         info.get_all_objects_func = db.get_person_handles
+        info.get_count_func = db.get_number_of_people
+        info.iter_objects_func = db.iter_people
         info.getfunc = db.get_person_from_handle
         info.commitfunc = db.commit_person
         info.execute_func = execute_person
@@ -818,6 +1669,8 @@ def get_category_info(db, category_name):
         info.proxyclass = PersonProxy
     if category_name == "Families":
         info.get_all_objects_func = db.get_family_handles
+        info.get_count_func = db.get_number_of_families
+        info.iter_objects_func = db.iter_families
         info.getfunc = db.get_family_from_handle
         info.commitfunc = db.commit_family
         info.execute_func = execute_family
@@ -828,6 +1681,8 @@ def get_category_info(db, category_name):
         info.proxyclass = FamilyProxy
     if category_name == "Places":
         info.get_all_objects_func = db.get_place_handles
+        info.get_count_func = db.get_number_of_places
+        info.iter_objects_func = db.iter_places
         info.getfunc = db.get_place_from_handle
         info.commitfunc = db.commit_place
         info.execute_func = execute_place
@@ -838,6 +1693,8 @@ def get_category_info(db, category_name):
         info.proxyclass = PlaceProxy
     if category_name == "Events":
         info.get_all_objects_func = db.get_event_handles
+        info.get_count_func = db.get_number_of_events
+        info.iter_objects_func = db.iter_events
         info.getfunc = db.get_event_from_handle
         info.commitfunc = db.commit_event
         info.execute_func = execute_event
@@ -848,6 +1705,8 @@ def get_category_info(db, category_name):
         info.proxyclass = EventProxy
     if category_name == "Citations":
         info.get_all_objects_func = db.get_citation_handles
+        info.get_count_func = db.get_number_of_citations
+        info.iter_objects_func = db.iter_citations
         info.getfunc = db.get_citation_from_handle
         info.commitfunc = db.commit_citation
         info.execute_func = execute_citation
@@ -858,6 +1717,8 @@ def get_category_info(db, category_name):
         info.proxyclass = CitationProxy
     if category_name == "Sources":
         info.get_all_objects_func = db.get_source_handles
+        info.get_count_func = db.get_number_of_sources
+        info.iter_objects_func = db.iter_sources
         info.getfunc = db.get_source_from_handle
         info.commitfunc = db.commit_source
         info.execute_func = execute_source
@@ -868,6 +1729,8 @@ def get_category_info(db, category_name):
         info.proxyclass = SourceProxy
     if category_name == "Repositories":
         info.get_all_objects_func = db.get_repository_handles
+        info.get_count_func = db.get_number_of_repositories
+        info.iter_objects_func = db.iter_repositories
         info.getfunc = db.get_repository_from_handle
         info.commitfunc = db.commit_repository
         info.execute_func = execute_repository
@@ -878,6 +1741,8 @@ def get_category_info(db, category_name):
         info.proxyclass = RepositoryProxy
     if category_name == "Notes":
         info.get_all_objects_func = db.get_note_handles
+        info.get_count_func = db.get_number_of_notes
+        info.iter_objects_func = db.iter_notes
         info.getfunc = db.get_note_from_handle
         info.execute_func = execute_note
         info.editfunc = EditNote
@@ -887,6 +1752,8 @@ def get_category_info(db, category_name):
         info.proxyclass = NoteProxy
     if category_name == "Media":
         info.get_all_objects_func = db.get_media_handles
+        info.get_count_func = db.get_number_of_media
+        info.iter_objects_func = db.iter_media
         info.getfunc = db.get_media_from_handle
         info.execute_func = execute_media
         info.editfunc = EditMedia